@@ -79,7 +79,8 @@ def create_app(config_name='development', queue=None, use_storage=None):
             SessionKey(app.config['QUEUE'].get())
 
         if app.config['USE_ETHEREUM']:
-            ethereum_utils = EthereumUtils(Web3(IPCProvider(get_ipc('./ethereum_private/data', 'geth.ipc'))))
+            ipc_path = get_ipc('./ethereum_private/data', 'geth.ipc')
+            ethereum_utils = EthereumUtils(Web3(IPCProvider(ipc_path)), ipc_path, app.config['ETHEREUM_POOL_SIZE'])
             storage_factory_abi = json.load(open('./ethereum_private/contracts/storage_factory.abi.json'))
             storage_abi = json.load(open('./ethereum_private/contracts/storage.abi.json'))
             ethereum_utils.init_contracts(get_env()['ETH_STORAGE'], storage_factory_abi, storage_abi)
@@ -72,12 +72,19 @@ def verify():
 
     if master_pass:
         current_app.config['MASTER_PASSWORD'] = master_pass
-        if current_app.config['USE_ETHEREUM']:
-            settings = Settings()
-            current_app.config['STORAGE'] = EthereumStorage(settings.ethereum_address, ethereum_pass)
-        else:
-            current_app.config['STORAGE'] = LocalStorage('chain')
-        return jsonify(message='Success')
+        # verifying again (e.g. after the session expired) keeps the storage, two storages would share their files
+        storage = current_app.config.get('STORAGE')
+        if storage is not None and storage.failed:
+            storage.terminate()
+            storage = None
+        if storage is None:
+            if current_app.config['USE_ETHEREUM']:
+                settings = Settings()
+                current_app.config['STORAGE'] = EthereumStorage(settings.ethereum_address, ethereum_pass)
+            else:
+                current_app.config['STORAGE'] = LocalStorage('chain')
+        # the storage loads its data in the background, 'storage ready' is emitted once it is done
+        return jsonify(message='Success', ready=current_app.config['STORAGE'].ready)
     error_respond.master_password_wrong()
 
 
@@ -100,31 +107,41 @@ def verify_with_account():
     except TypeError:
         error_respond.blockchain_account_wrong()
 
-    while not storage.loaded:
-        time.sleep(0.1)
-
-    master_pass_hash = storage.get(MASTER_KEY)
-    master_salt = storage.get(MASTER_SALT_KEY)
-    if master_pass_hash and master_salt:
-        settings = Settings()
-        settings.master_password_hash = master_pass_hash
-        settings.master_password_hash_salt = master_salt
-        master_pass = MasterPassword.verify(master_password_in_memory)
-        del master_password_in_memory
-        if master_pass:
-            current_app.config['MASTER_PASSWORD'] = master_pass
-            current_app.config['STORAGE'] = storage
-            settings.ethereum_address = account
-            settings.write()
-            current_app.config['INIT_STATE'] = 2
-            socketio.emit('state change', 2)
-            return jsonify(message='Success')
-        else:
-            settings.master_password_hash = ''
-            settings.master_password_hash_salt = ''
-            settings.write()
+    def verifying_worker(app):
+        """
+        The master password can only be verified once the storage has synced the hash, the result is emitted as a
+        'state change' to 2 on success, or as 'verification failed' with the error otherwise.
+        """
+        nonlocal master_password_in_memory
+        with app.app_context():
+            if not storage.wait_loaded():
+                storage.terminate()
+                socketio.emit('verification failed', 'Storage Not Loaded')
+                return
+            master_pass_hash = storage.get(MASTER_KEY)
+            master_salt = storage.get(MASTER_SALT_KEY)
+            if master_pass_hash and master_salt:
+                settings = Settings()
+                settings.master_password_hash = master_pass_hash
+                settings.master_password_hash_salt = master_salt
+                master_pass = MasterPassword.verify(master_password_in_memory)
+                del master_password_in_memory
+                if master_pass:
+                    current_app.config['MASTER_PASSWORD'] = master_pass
+                    current_app.config['STORAGE'] = storage
+                    settings.ethereum_address = account
+                    settings.write()
+                    current_app.config['INIT_STATE'] = 2
+                    socketio.emit('state change', 2)
+                    return
+                settings.master_password_hash = ''
+                settings.master_password_hash_salt = ''
+                settings.write()
+                error = 'Master Password Wrong'
+            else:
+                error = 'Blockchain Account Wrong'
             storage.terminate()
-            error_respond.master_password_wrong()
+            socketio.emit('verification failed', error)
 
-    storage.terminate()
-    error_respond.blockchain_account_wrong()
+    Thread(target=verifying_worker, daemon=True, args=(current_app._get_current_object(),)).start()
+    return jsonify(message='Pending')
@@ -5,7 +5,7 @@ from flask import Blueprint, current_app, jsonify, request, json
 from app import SessionKey, socketio
 from app.models import KeyLookupTable
 from app.utils import error_respond
-from app.utils.decorators import session_verify, master_password_verify
+from app.utils.decorators import session_verify, master_password_verify, storage_ready
 from app.utils.master_password import MasterPassword
 from app.utils.misc import base64_decode, base64_encode
 
@@ -24,6 +24,7 @@ def simple_encrypt_from_dict(master_password: MasterPassword, data: Union[dict,
 
 @bp.route('/')
 @master_password_verify
+@storage_ready
 def get_table():
     hidden = request.args.get('hidden')
     master_password: MasterPassword = current_app.config['MASTER_PASSWORD']
@@ -66,6 +67,7 @@ def get_table():
 @session_verify
 # FIXME: this may not need to verify the master password
 @master_password_verify
+@storage_ready
 def persistent():
     data = json.loads(request.decrypted_data.decode())
     try:
@@ -82,6 +84,7 @@ def persistent():
 @bp.route('/get/', methods=['POST'])
 @session_verify
 @master_password_verify
+@storage_ready
 def get():
     master_password: MasterPassword = current_app.config['MASTER_PASSWORD']
     data = json.loads(request.decrypted_data.decode())
@@ -102,6 +105,7 @@ def get():
 @bp.route('/new/', methods=['POST'])
 @session_verify
 @master_password_verify(2)
+@storage_ready
 def new():
     master_password: MasterPassword = current_app.config['MASTER_PASSWORD']
     data = json.loads(request.decrypted_data.decode())
@@ -122,6 +126,7 @@ def new():
 @bp.route('/modify/', methods=['POST'])
 @session_verify
 @master_password_verify(4)
+@storage_ready
 def modify():
     master_password: MasterPassword = current_app.config['MASTER_PASSWORD']
     data = json.loads(request.decrypted_data.decode())
@@ -164,6 +169,7 @@ def modify():
 @bp.route('/delete/', methods=['POST'])
 @session_verify
 @master_password_verify
+@storage_ready
 def delete():
     storage = current_app.config['STORAGE']
     data = json.loads(request.decrypted_data.decode())
@@ -183,6 +189,7 @@ def delete():
 @bp.route('/mark/', methods=['POST'])
 @session_verify
 @master_password_verify
+@storage_ready
 def mark():
     data = json.loads(request.decrypted_data.decode())
     key = data.get('key')
@@ -1,6 +1,7 @@
 import {encryptAndAuthenticate, ensureSession} from '@/utils';
 import mdui from 'mdui';
 import NewPasswordView from '@c/NewPasswordView';
+import io from 'socket.io-client';
 
 export default {
   name: 'guard-view',
@@ -14,6 +15,29 @@ export default {
   components: {
     NewPasswordView
   },
+  mounted() {
+    // verification with an account finishes in the background, after the storage has synced
+    this.socket = io();
+    this.socket.on('verification failed', (error) => {
+      this.verifying = false;
+      if (error === 'Master Password Wrong') {
+        mdui.alert('Verification failed');
+      } else if (error === 'Storage Not Loaded') {
+        mdui.alert('The storage could not be loaded');
+      } else {
+        mdui.alert('Blockchain Account Wrong!');
+      }
+    });
+    this.socket.on('state change', (state) => {
+      if (state === 2) {
+        this.verifying = false;
+        this.$emit('verified-with-account');
+      }
+    });
+  },
+  beforeDestroy() {
+    this.socket.close();
+  },
   updated() {
     mdui.mutation();
   },
@@ -102,11 +126,9 @@ export default {
             hmac: hmac
           }),
           contentType: 'application/json',
-          success: () => {
-            this.$emit('verified-with-account');
-          },
           statusCode: {
             '400': () => {
+              this.verifying = false;
               mdui.alert('Blockchain Account Wrong!');
             },
             '401': (res) => {
@@ -117,10 +139,8 @@ export default {
                 // Fixme: general bad situation
                 mdui.alert('Session Key broken!');
               }
+              this.verifying = false;
             }
-          },
-          complete: () => {
-            this.verifying = false;
           }
         });
       });
@@ -17,7 +17,8 @@ export default {
     return {
       items: [],
       sortBy: '1',
-      showHidden: false
+      showHidden: false,
+      sync: null
     };
   },
   mounted() {
@@ -30,6 +31,16 @@ export default {
       socket: io()
     };
     this.localData.socket.on('refresh password', this.fetchPasswords.bind(this));
+    this.localData.socket.on('storage ready', (status) => {
+      if (status.ready) {
+        this.fetchPasswords();
+      } else {
+        mdui.alert('The storage could not be loaded: ' + status.error);
+      }
+    });
+    this.localData.socket.on('sync progress', (progress) => {
+      this.sync = progress.loaded < progress.total ? progress : null;
+    });
   },
 
   beforeDestroy() {
@@ -5,7 +5,8 @@ from functools import wraps
 from flask import request, current_app
 
 from app.utils.cipher import decrypt_and_verify
-from app.utils.error_respond import invalid_post_data, authentication_failure, master_password_expired
+from app.utils.error_respond import (invalid_post_data, authentication_failure, master_password_expired,
+                                     storage_not_loaded)
 from app.utils.exceptions import StateError
 from app.utils.misc import base64_decode
 from app.utils.session_key import SessionKey
@@ -166,3 +167,32 @@ def unset_state(state_name):
         return __wrapper
 
     return __decorator
+
+
+def storage_ready(func):
+    """
+    Waits until the storage in `current_app.config['STORAGE']` has loaded its data before handling the request, and
+    responds with an error if it could not be loaded.
+    """
+
+    @wraps(func)
+    def __wrapper(*args, **kwargs):
+        storage = current_app.config.get('STORAGE')
+        if storage is not None and not storage.wait_ready():
+            storage_not_loaded()
+        return func(*args, **kwargs)
+
+    return __wrapper
+
+
+def pooled(func):
+    """
+    Runs the method with a connection of `self._connections` (a `ConnectionPool`) checked out by the current thread.
+    """
+
+    @wraps(func)
+    def __wrapper(self, *args, **kwargs):
+        with self._connections.connection():
+            return func(self, *args, **kwargs)
+
+    return __wrapper
@@ -31,3 +31,7 @@ def key_not_found():
 
 def blockchain_account_wrong():
     abort(make_response(jsonify(error='Blockchain Account Wrong'), 400))
+
+
+def storage_not_loaded():
+    abort(make_response(jsonify(error='Storage Not Loaded'), 503))
@@ -1,6 +1,7 @@
 import time
+from itertools import chain
 from threading import Thread, Lock, Event
-from typing import Optional, Union, Tuple, Generator, Dict, Set
+from typing import Optional, Union, Tuple, Generator, Dict, Set, Iterable, List
 
 from flask import current_app
 from web3.exceptions import BadFunctionCallOutput
@@ -9,24 +10,52 @@ from app import socketio
 from app.utils.settings import Settings
 from app.models import KeyLookupTable
 from app.utils.ethereum_utils import EthereumUtils
-from app.utils.misc import Address
+from app.utils.exceptions import StateError
+from app.utils.flush_scheduler import FlushScheduler
+from app.utils.misc import Address, Priority, StorageEntry
+from app.utils.write_journal import WriteJournal
 
 
 class EthereumStorage:
-    def __init__(self, account: Address, password: str):
+    # number of remote elements merged into the cache each time the lock is taken while syncing
+    APPLY_CHUNK_SIZE = 256
+    # a new checkpoint of the materialized state is written after this many entries
+    CHECKPOINT_INTERVAL = 1000
+    # bulk changes are sent one transaction of at most this much gas at a time, leaving room in the blocks for the
+    # interactive ones
+    BULK_GAS_LIMIT = 2000000
+    # delays between attempts to send changes while the node fails, doubled after each failure
+    MIN_RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, account: Address, password: str, journal_path: Optional[str] = None):
         """
         Load the ethereum storage for `account`. `password` should also be provided.
 
+        The changes not persisted yet are kept in a `WriteJournal` at `journal_path` (`./db/<account>.journal` by
+        default), and are sent again after a restart.
+
         **Assumptions**:
 
         1. Singleton class EthereumUtils has been initialized before
         2. Contracts has been initialized (EthereumUtils.init_contracts)
         3. Storage contract for `account` has been created (EthereumUtils.new_storage)
+
+        :raise: `StateError` if the journal is used by another storage
         """
-        self.__cache_dict: Dict[str, Tuple[str, bool]] = {}
+        self.__cache_dict: Dict[str, StorageEntry] = {}
 
         self.__change_set: Set[str] = set()
         self.__delete_set: Set[str] = set()
+        # keys whose value in the cache has not been sent yet
+        self.__dirty: Set[str] = set()
+        # persisted values of the changed keys that were persisted before, to detect changes reverted before a flush
+        self.__original: Dict[str, str] = {}
+        # gas estimates of the pending operations, keys changed since the last estimation are in `__unestimated`
+        self.__pending_gas: Dict[str, int] = {}
+        self.__pending_gas_total = 0
+        self.__unestimated: Set[str] = set()
+        self.__cost_error: Optional[float] = None
 
         self.__ethereum_utils = EthereumUtils()
         self.__account = account
@@ -39,72 +68,240 @@ class EthereumStorage:
         self.__lock = Lock()
         self.__terminating = False
 
-        self.__store_interval = 15
         self.__load_interval = 5
-        self.__store_event = Event()
-        self.__blockchain_length = Settings().blockchain_length
-        self.__blockchain = Settings().blockchain
+        self.__resend_timeout = 120
+        # priority class of each pending change, and the flush scheduler of each class
+        self.__priorities: Dict[str, str] = {}
+        self.__schedulers = {
+            Priority.INTERACTIVE: FlushScheduler(idle_delay=0.5, max_delay=2, max_count=50, max_bytes=8 * 1024),
+            Priority.BULK: FlushScheduler()
+        }
+        self.__blockchain_length = 0
+        self.__checkpoint_length = 0
+        self.__synced_block = Settings().blockchain_synced_block
+
+        self.__journal = WriteJournal(journal_path or './db/%s.journal' % account)
+        # new hashes of the transactions sent again, by their old hashes
+        self.__resent: Dict[str, str] = {}
+
+        # set once the mirror has been loaded from disk, and once the first sync with the network has finished
+        self.__ready = Event()
+        self.__load_error: Optional[Exception] = None
+        self.__loaded = Event()
+
+        self.__app = current_app._get_current_object()
 
-        # load blockchain from disk
-        for k, v in self.__blockchain:
+        # the mirror is loaded in the background, the data methods wait until it is ready
+        self.__load_thread = Thread(target=self.load_worker, daemon=True)
+        self.__store_threads = [Thread(target=self.store_worker, args=(priority,), daemon=True)
+                                for priority in self.__schedulers]
+        self.__warm_up_thread = Thread(target=self.warm_up_worker, daemon=True)
+        self.__warm_up_thread.start()
+
+    def warm_up_worker(self):
+        """
+        Loads the mirror and the changes of the journal from disk, then starts the workers syncing it with the
+        network.
+        """
+        try:
+            with self.__app.app_context():
+                self.__load_mirror()
+        except Exception as e:
+            print(e)
+            self.__load_error = e
+        finally:
+            self.__ready.set()
+        if self.__load_error is not None:
+            # the data methods raise from now on, and nothing is synced on top of a partly loaded mirror
+            self.__loaded.set()
+            socketio.emit('storage ready', {'ready': False, 'error': str(self.__load_error)})
+            return
+        socketio.emit('storage ready', {'ready': True})
+        if not self.__terminating:
+            self.__load_thread.start()
+            for thread in self.__store_threads:
+                thread.start()
+
+    def __load_mirror(self):
+        # load the checkpointed state and the entries after it
+        self.__checkpoint_length, state = Settings().state_checkpoint
+        for k, v in state.items():
+            self.__cache_dict[k] = StorageEntry(v, True)
+        del state
+        for k, v in Settings().iter_blockchain(self.__checkpoint_length):
             if v == '':
-                del self.__cache_dict[k]
+                self.__cache_dict.pop(k, None)
             else:
-                self.__cache_dict[k] = (v, True)
+                self.__cache_dict[k] = StorageEntry(v, True)
+        self.__blockchain_length = Settings().blockchain_length
+        if self.__blockchain_length - self.__checkpoint_length >= EthereumStorage.CHECKPOINT_INTERVAL:
+            self.__write_checkpoint()
 
-        # make up for the missing entries (delete entries that have not sync'ed)
-        for k in self.__cache_dict:
-            if not k.startswith('__') and KeyLookupTable.query.get(k) is None:
-                new_entry = KeyLookupTable(key=k, meta_data='', hidden=False)
-                KeyLookupTable.query.session.add(new_entry)
+        # the changes sent before a restart are shown as not persisted until their transactions are found mined, the
+        # changes not sent are pending again
+        with self.__lock:
+            for entries in self.__journal.in_flight.values():
+                for k, v in entries:
+                    if v:
+                        self.__cache_dict[k] = StorageEntry(v, False)
+                    else:
+                        self.__cache_dict.pop(k, None)
+            for k, (v, priority) in self.__journal.pending.items():
+                if v:
+                    self.__add(k, v, priority)
+                elif k in self.__cache_dict:
+                    self.__delete(k, priority)
+                else:
+                    self.__journal.drop(k)
 
+        # make up for the missing entries (delete entries that have not sync'ed)
+        existing = {k for k, in KeyLookupTable.query.with_entities(KeyLookupTable.key)}
+        KeyLookupTable.query.session.add_all([KeyLookupTable(key=k, meta_data='', hidden=False)
+                                              for k in self.__cache_dict.keys() - existing if not k.startswith('__')])
         KeyLookupTable.query.session.commit()
 
-        self.__load_thread = Thread(target=self.load_worker, daemon=True)
-        self.__store_thread = Thread(target=self.store_worker, daemon=True)
-        self.__load_thread.start()
-        self.__store_thread.start()
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the mirror has been loaded from disk, at most `timeout` seconds. Returns whether it is loaded,
+        `False` if loading it failed.
+        """
+        return self.__ready.wait(timeout) and self.__load_error is None
 
-        self.__loaded = False
+    def wait_loaded(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the first sync with the network has finished, at most `timeout` seconds. Returns whether it has,
+        `False` if loading the mirror failed.
+        """
+        return self.__loaded.wait(timeout) and self.__load_error is None
 
-        self.__app = current_app._get_current_object()
+    def __wait_ready(self):
+        """
+        Waits until the mirror has been loaded from disk.
 
-    def add(self, k: str, v: str):
+        :raise: `StateError` if loading it failed
+        """
+        self.__ready.wait()
+        if self.__load_error is not None:
+            raise StateError('The storage could not be loaded: %s' % self.__load_error)
+
+    def add(self, k: str, v: str, priority: str = Priority.INTERACTIVE):
         """
         Add a new entry with key `k` and value `v` into the database. If the entry with key `k` exists,
         update its value with `v`. **This will not immediately write the underlying database.**
-        """
 
+        Interactive changes are sent first, bulk changes (`Priority.BULK`) are rate-limited. The change is in the
+        journal when this returns.
+        """
+        self.__wait_ready()
         with self.__lock:
-            if k in self.__cache_dict and self.__cache_dict[k][1]:
+            changed = self.__add(k, v, priority)
+        if changed:
+            socketio.emit('persistence change', k)
+
+    def __add(self, k: str, v: str, priority: str) -> bool:
+        """
+        Applies and journals the change of `add`, returns whether the key has changed. Should be called with the lock
+        held.
+        """
+        entry = self.__cache_dict.get(k)
+        if k in self.__dirty or k in self.__delete_set:
+            if self.__original.get(k) == v:
+                # changed back to the persisted value, nothing to send
+                self.__revert(k)
+                return True
+        elif entry is not None:
+            if entry.value == v:
+                # persisted or being sent already
+                self.__schedulers[priority].skip()
+                self.__journal.drop(k)
+                return False
+            if entry.persisted:
+                self.__original[k] = entry.value
+        if k not in self.__dirty:
+            if k in self.__cache_dict:
                 self.__change_set.add(k)
             elif k in self.__delete_set:
                 self.__delete_set.remove(k)
                 self.__change_set.add(k)
-            self.__cache_dict[k] = (v, False)
-        socketio.emit('persistence change', k)
-
-    def delete(self, k: str):
+        self.__cache_dict[k] = StorageEntry(v, False)
+        self.__dirty.add(k)
+        self.__invalidate_gas(k)
+        self.__lane(k, priority).changed(k, len(k) + len(v))
+        self.__journal.write(k, v, self.__priorities[k])
+        return True
+
+    def __lane(self, k: str, priority: str) -> FlushScheduler:
+        """
+        Returns the scheduler of the pending change to `k`. A bulk change becomes interactive if changed with the
+        interactive priority, but not the other way round. Should be called with the lock held.
+        """
+        current = self.__priorities.get(k)
+        if current is not None and current != priority:
+            if current == Priority.INTERACTIVE:
+                return self.__schedulers[current]
+            self.__schedulers[current].discard(k)
+        self.__priorities[k] = priority
+        return self.__schedulers[priority]
+
+    def __revert(self, k: str):
+        """
+        Drops the pending change to `k`, restoring its persisted value. Should be called with the lock held.
+        """
+        self.__dirty.discard(k)
+        self.__change_set.discard(k)
+        self.__delete_set.discard(k)
+        self.__cache_dict[k] = StorageEntry(self.__original.pop(k), True)
+        self.__unestimated.discard(k)
+        self.__pending_gas_total -= self.__pending_gas.pop(k, 0)
+        self.__schedulers[self.__priorities.pop(k)].cancel(k)
+        self.__journal.drop(k)
+
+    def delete(self, k: str, priority: str = Priority.INTERACTIVE):
         """
         Delete an entry in database with key `k`. If the key does not exist, an exception `KeyError` will be thrown.
         **This will not immediately write the underlying database.**
         """
+        self.__wait_ready()
         with self.__lock:
-            if k in self.__cache_dict:
-                if not self.__cache_dict[k][1]:
-                    if k in self.__change_set:
-                        # changed in cache
-                        self.__delete_set.add(k)
-                        del self.__cache_dict[k]
-                        self.__change_set.remove(k)
-                    else:
-                        # new in cache, not changed in cache
-                        del self.__cache_dict[k]
-                else:
+            self.__delete(k, priority)
+
+    def __delete(self, k: str, priority: str):
+        """
+        Applies and journals the change of `delete`. Should be called with the lock held.
+        """
+        if k in self.__cache_dict:
+            self.__invalidate_gas(k)
+            if k in self.__dirty:
+                self.__dirty.remove(k)
+                if k in self.__change_set:
+                    # changed in cache
                     self.__delete_set.add(k)
                     del self.__cache_dict[k]
+                    self.__change_set.remove(k)
+                    self.__lane(k, priority).changed(k, len(k))
+                    self.__journal.write(k, '', self.__priorities[k])
+                else:
+                    # new in cache, not changed in cache: the add and the delete cancel out
+                    self.__unestimated.discard(k)
+                    del self.__cache_dict[k]
+                    self.__schedulers[self.__priorities.pop(k)].cancel(k)
+                    self.__journal.drop(k)
             else:
-                raise KeyError(k)
+                if self.__cache_dict[k].persisted:
+                    self.__original[k] = self.__cache_dict[k].value
+                self.__delete_set.add(k)
+                del self.__cache_dict[k]
+                self.__lane(k, priority).changed(k, len(k))
+                self.__journal.write(k, '', self.__priorities[k])
+        else:
+            raise KeyError(k)
+
+    def __invalidate_gas(self, k: str):
+        """
+        Drops the gas estimate of the pending operation on `k`, it will be estimated again by `calculate_total_cost`.
+        """
+        self.__pending_gas_total -= self.__pending_gas.pop(k, 0)
+        self.__unestimated.add(k)
 
     def get(self, k: str, check_persistence: bool = False) -> Union[Optional[str], Tuple[Optional[str], bool]]:
         """
@@ -114,8 +311,9 @@ class EthereumStorage:
         `store`d into the underlying database. If `check_persistence` is `True` and the key does not exist, return
         `(None, None)`.
         """
-
-        result = self.__cache_dict.get(k, (None, None))
+        self.__wait_ready()
+        entry = self.__cache_dict.get(k)
+        result = (None, None) if entry is None else (entry.value, entry.persisted)
         if check_persistence:
             return result
         else:
@@ -131,38 +329,87 @@ class EthereumStorage:
         }
 
         """
+        self.__wait_ready()
         return self.__cache_dict
 
     def __get_all_add(self) -> Generator[Tuple[str, str], None, None]:
-        return ((k, v[0]) for k, v in self.__cache_dict.items() if not v[1])
+        return ((k, self.__cache_dict[k].value) for k in self.__dirty)
 
     def __get_all_del(self) -> Generator[str, None, None]:
         return (k for k in self.__delete_set)
 
-    def store(self):
+    def store(self, priority: Optional[str] = None):
         """
-        Synchronize the changes with underlying database.
+        Synchronize the changes with underlying database. If `priority` is set, only the changes of this priority are
+        sent, and bulk changes only as many as fit in one transaction (unless terminating).
         """
 
         self.__ethereum_utils.unlock_account(self.__account, self.__password, duration=60)
 
-        # FIXME: use async add
         # TODO: how to determine if a key is really stored? only update persistence if transaction mined?
-        add_list = []
+        # the changes are taken under the lock, but sent without holding it
+        gas_limit = EthereumUtils.BATCH_GAS_LIMIT
         with self.__lock:
-            for k, v in self.__get_all_add():
-                print('adding:', k, v)
-                add_list.append((k, v, self.__ethereum_utils.add_async(self.__account, k, v)))
-
-            for k in self.__get_all_del():
-                print('deleting:', k)
-                add_list.append((None, None, self.__ethereum_utils.add_async(self.__account, k)))
-
-            self.__change_set = set()
-            self.__delete_set = set()
-
+            pending = chain(self.__get_all_add(), ((k, '') for k in self.__get_all_del()))
+            entries = [(k, v) for k, v in pending if priority is None or self.__priorities[k] == priority]
+            if priority == Priority.BULK and entries and not self.__terminating:
+                gas_limit = EthereumStorage.BULK_GAS_LIMIT
+                entries = EthereumUtils.pack_batches(entries, gas_limit)[0]
+
+            change_set = set()
+            priorities = {}
+            for k, v in entries:
+                if v:
+                    print('adding:', k, v)
+                else:
+                    print('deleting:', k)
+                if k in self.__change_set:
+                    change_set.add(k)
+                priorities[k] = self.__priorities.pop(k)
+                self.__change_set.discard(k)
+                self.__delete_set.discard(k)
+                self.__dirty.discard(k)
+                self.__original.pop(k, None)
+                self.__unestimated.discard(k)
+                self.__pending_gas_total -= self.__pending_gas.pop(k, 0)
+            for p, scheduler in self.__schedulers.items():
+                scheduler.take(k for k, _ in entries if priorities[k] == p)
+
+        if not entries:
+            return []
+        try:
+            # sent in as few transactions as fit in the gas limit
+            add_list = self.__ethereum_utils.add_batch_async(self.__account, entries, gas_limit)
+        except Exception:
+            self.__restore(entries, change_set, priorities)
+            raise
+        for batch, transaction_hash in add_list:
+            self.__journal.sent(batch, transaction_hash)
         return add_list
 
+    def __restore(self, entries: List[Tuple[str, str]], change_set: Set[str], priorities: Dict[str, str]):
+        """
+        Puts back the changes in `entries` that could not be sent, unless the keys have been changed again since.
+        """
+        with self.__lock:
+            for k, v in entries:
+                if k in self.__dirty or k in self.__delete_set:
+                    continue
+                entry = self.__cache_dict.get(k)
+                if v and entry is not None and entry.value == v:
+                    self.__dirty.add(k)
+                    if k in change_set:
+                        self.__change_set.add(k)
+                    self.__invalidate_gas(k)
+                    self.__lane(k, priorities[k]).changed(k, len(k) + len(v))
+                elif not v and entry is None:
+                    self.__delete_set.add(k)
+                    self.__invalidate_gas(k)
+                    self.__lane(k, priorities[k]).changed(k, len(k))
+                else:
+                    continue
+                self.__journal.write(k, v, self.__priorities[k])
+
     def estimate_cost(self, args: dict) -> int:
         """
         Estimates the cost of the storage operation with arguments `args`.
@@ -170,19 +417,32 @@ class EthereumStorage:
         # FIXME: it returns gas count (gas count * gas price = cost in wei)
         key = args['key']
         value = args['value']
-        return self.__ethereum_utils.estimate_add_cost(self.__account, key, value)
+        gas, self.__cost_error = self.__ethereum_utils.model_add_cost(self.__account, key, value)
+        return gas
 
     def calculate_total_cost(self) -> int:
         """
         Calculates the cost of currently cached storage operations.
         """
         # FIXME: it returns gas count (gas count * gas price = cost in wei)
-        s = 0
-        for k, v in self.__get_all_add():
-            s += self.__ethereum_utils.estimate_add_cost(self.__account, k, v)
-        for k in self.__get_all_del():
-            s += self.__ethereum_utils.estimate_add_cost(self.__account, k)
-        return s
+        with self.__lock:
+            unestimated = [(k, self.__cache_dict[k].value if k in self.__dirty else '') for k in self.__unestimated]
+            self.__unestimated = set()
+        # only the operations changed since the last call are estimated, with the offline gas model
+        for k, v in unestimated:
+            gas, self.__cost_error = self.__ethereum_utils.model_add_cost(self.__account, k, v)
+            with self.__lock:
+                if k not in self.__unestimated and (k in self.__dirty or k in self.__delete_set):
+                    self.__pending_gas_total += gas - self.__pending_gas.get(k, 0)
+                    self.__pending_gas[k] = gas
+        return self.__pending_gas_total
+
+    @property
+    def cost_error(self) -> Optional[float]:
+        """
+        Relative error of the gas model behind `estimate_cost` and `calculate_total_cost`, `None` before any estimate.
+        """
+        return self.__cost_error
 
     def balance(self) -> int:
         """
@@ -199,6 +459,7 @@ class EthereumStorage:
         return self.__account
 
     def size(self) -> int:
+        self.__wait_ready()
         return len(self.__cache_dict)
 
     def __setitem__(self, key, value):
@@ -213,90 +474,269 @@ class EthereumStorage:
     def __len__(self):
         return self.size()
 
-    def store_worker(self):
+    def store_worker(self, priority: str):
+        """
+        Sends the changes of `priority`, each time its scheduler decides to, and waits for them to be mined. Each
+        priority has its own worker, so that interactive changes are not held up by bulk ones being mined. The bulk
+        worker first deals with the transactions sent before a restart.
+        """
+        scheduler = self.__schedulers[priority]
+        recovered = priority != Priority.BULK
+        delay = EthereumStorage.MIN_RETRY_DELAY
         while True:
             try:
-                self.__store_event.set()
+                if not recovered:
+                    self.__recover()
+                    recovered = True
 
-                add_list = self.store()
+                # flushes when the scheduler decides to, or the storage is terminating
+                scheduler.wait()
+                add_list = self.store(priority)
 
                 if self.__terminating:
                     # Terminating, hopefully someone will mine our transaction :)
                     return
 
-                finished = set()
-                while len(finished) < len(add_list):
-                    for k, v, h in add_list:
-                        if h not in finished and self.__ethereum_utils.get_transaction_receipt(h):
-                            finished.add(h)
-                            if k:
-                                with self.__lock:
-                                    if self.__cache_dict.get(k)[0] == v:
-                                        self.__cache_dict[k] = (v, True)
-                                socketio.emit('persistence change', k)
-                    time.sleep(0.01)
-
-                self.__store_event.clear()
-                time.sleep(self.__store_interval)
+                self.__wait_mined({h: entries for entries, h in add_list})
+                delay = EthereumStorage.MIN_RETRY_DELAY
             except Exception as e:
+                # the changes are kept until the node is reachable again
                 print(e)
-                time.sleep(self.__store_interval)
+                if self.__terminating:
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, EthereumStorage.MAX_RETRY_DELAY)
+
+    def __recover(self):
+        """
+        Deals with the transactions of the journal, sent before a restart: the ones known to the node are waited for
+        as usual, the entries of the ones lost are pending again (as bulk changes) instead of being sent twice.
+        """
+        sent = self.__journal.in_flight
+        lost = [h for h in sent if self.__ethereum_utils.get_transaction(h) is None]
+        for h in lost:
+            entries = sent.pop(h)
+            self.__restore(entries, {k for k, _ in entries}, {k: Priority.BULK for k, _ in entries})
+            self.__journal.mined(h)
+        self.__wait_mined(sent)
+
+    def __wait_mined(self, sent: Dict[str, List[Tuple[str, str]]]):
+        """
+        Waits for the transactions in `sent` (hash -> entries) to be mined, sending them again if the node dropped
+        them. Persistence is updated as soon as the block including a transaction arrives.
+        """
+        unfinished = set(sent)
+        while unfinished:
+            unfinished = self.__ethereum_utils.wait_transactions(
+                unfinished, lambda h, receipt: self.__on_mined(h, sent[h]), self.__resend_timeout)
+            if unfinished:
+                # the node may have dropped a transaction, which blocks the later ones, send it again
+                self.__ethereum_utils.unlock_account(self.__account, self.__password, duration=60)
+                resent = self.__ethereum_utils.refill_nonce_gaps(self.__account)
+                for old_hash, new_hash in resent.items():
+                    self.__journal.resent(old_hash, new_hash)
+                # the transactions sent again may be waited for by the other worker
+                with self.__lock:
+                    self.__resent.update(resent)
+                    for old_hash in [h for h in unfinished if h in self.__resent]:
+                        new_hash = self.__resent.pop(old_hash)
+                        sent[new_hash] = sent.pop(old_hash)
+                        unfinished.discard(old_hash)
+                        unfinished.add(new_hash)
+
+    def __on_mined(self, transaction_hash: str, entries: List[Tuple[str, str]]):
+        self.__journal.mined(transaction_hash)
+        for k, v in entries:
+            if v:
+                with self.__lock:
+                    entry = self.__cache_dict.get(k)
+                    if entry is not None and entry.value == v and k not in self.__dirty:
+                        entry.persisted = True
+                socketio.emit('persistence change', k)
+
+    def load_key_value(self, k: str, v: str) -> bool:
+        """
+        Applies a remote element to the cache, should be called with the lock held. Returns whether the cache took the
+        value, `KeyLookupTable` is updated separately by `update_lookup_table` in that case.
 
-    def load_key_value(self, k: str, v: str):
-        self.__blockchain.append((k, v))
+        A pending local change to `k` is kept: it is sent after the element, so it overrides it on the chain as well.
+        The element only becomes the persisted value the change is made against.
+        """
+        if k in self.__priorities:
+            if v == '':
+                # the key is new to the chain, deleting it again cancels the change
+                self.__original.pop(k, None)
+                self.__change_set.discard(k)
+            else:
+                self.__original[k] = v
+                if k in self.__dirty:
+                    self.__change_set.add(k)
+            return False
         if v == '':
-            del self.__cache_dict[k]
-            if not k.startswith('__'):
-                KeyLookupTable.query.filter_by(key=k).delete()
+            # also when syncing back a deletion of ours
+            self.__cache_dict.pop(k, None)
         else:
-            self.__cache_dict[k] = (v, True)
-            if not k.startswith('__'):
-                old_entry = KeyLookupTable.query.get(k)
-                if old_entry:
-                    old_entry.meta_data = ''
-                else:
-                    new_entry = KeyLookupTable(key=k, meta_data='', hidden=False)
-                    KeyLookupTable.query.session.add(new_entry)
+            self.__cache_dict[k] = StorageEntry(v, True)
+        return True
+
+    @staticmethod
+    def update_lookup_table(k: str, v: str):
+        if k.startswith('__'):
+            return
+        if v == '':
+            KeyLookupTable.query.filter_by(key=k).delete()
+        else:
+            old_entry = KeyLookupTable.query.get(k)
+            if old_entry:
+                old_entry.meta_data = ''
+            else:
+                new_entry = KeyLookupTable(key=k, meta_data='', hidden=False)
+                KeyLookupTable.query.session.add(new_entry)
 
     def load_worker(self):
         while True:
             try:
                 if self.__terminating:
                     return
-                new_length = self.__ethereum_utils.get_length(self.__account)
-                print('load', self.__blockchain_length, new_length)
-                if new_length > self.__blockchain_length:
-                    self.__store_event.wait()
-                    with self.__lock:
-                        with self.__app.app_context():
-                            for k, v in self.__ethereum_utils.get_history(self.__account, self.__blockchain_length,
-                                                                          self.__storage):
-                                print('loading:', k, v)
-                                self.load_key_value(k, v)
-
-                            self.__blockchain_length = new_length
-                            KeyLookupTable.query.session.commit()
-                            Settings().blockchain_length = new_length
-                            Settings().blockchain = self.__blockchain
-                            Settings().write()
-                    socketio.emit('refresh password')
+                if self.__ethereum_utils.has_added_event(self.__storage):
+                    self.__sync_events()
+                else:
+                    self.__sync_index()
 
             except BadFunctionCallOutput:
+                # there is no storage contract, nothing can be loaded
                 break
             except Exception as e:
+                # e.g. `IncompleteResponseError`, retried on the next round
                 print(e)
             finally:
-                self.__loaded = True
+                self.__loaded.set()
                 time.sleep(self.__load_interval)
 
+    def __sync_index(self):
+        """
+        Loads the new elements of the storage contract by index, used for contracts without the `Added` event.
+        """
+        new_length = self.__ethereum_utils.get_length(self.__account)
+        print('load', self.__blockchain_length, new_length)
+        if new_length > self.__blockchain_length:
+            self.__apply(self.__ethereum_utils.get_history(self.__account, self.__blockchain_length, self.__storage,
+                                                           new_length, self.__sync_progress), new_length)
+
+    def __sync_events(self):
+        """
+        Loads the new elements of the storage contract from the `Added` events in the blocks mined since the last
+        synced block. Does nothing, and makes no calls to the contract, while no new blocks are mined.
+        """
+        head = self.__ethereum_utils.get_block_number()
+        if head <= self.__synced_block:
+            return
+        print('load events', self.__synced_block + 1, head)
+        added = [(i, k, v) for i, k, v in self.__ethereum_utils.get_added(self.__storage, self.__synced_block + 1, head)
+                 if i >= self.__blockchain_length]
+        if any(i != self.__blockchain_length + n for n, (i, _, _) in enumerate(added)):
+            # some events are missing (e.g. the logs of old blocks have been pruned), read the elements by index
+            self.__sync_index()
+        elif added:
+            self.__apply(((k, v) for _, k, v in added), self.__blockchain_length + len(added))
+        self.__synced_block = head
+        Settings().blockchain_synced_block = head
+        Settings().write()
+
+    def __apply(self, elements: Iterable[Tuple[str, str]], new_length: int):
+        """
+        Applies the remote `elements`, fetched without holding the lock. The lock is only taken to merge each chunk of
+        `APPLY_CHUNK_SIZE` elements into the cache, the changes made meanwhile are kept (see `load_key_value`). The
+        length and `Settings` are only updated once all the elements have been fetched, if the fetch fails the next
+        sync starts from the same length again.
+        """
+        with self.__app.app_context():
+            start = self.__blockchain_length
+            unsaved = []
+            chunk = []
+            for element in elements:
+                chunk.append(element)
+                if len(chunk) >= EthereumStorage.APPLY_CHUNK_SIZE:
+                    self.__merge(chunk)
+                    unsaved.extend(chunk)
+                    chunk = []
+            self.__merge(chunk)
+            unsaved.extend(chunk)
+
+            KeyLookupTable.query.session.commit()
+            # only the new entries are written
+            Settings().append_blockchain(unsaved, start, new_length)
+            with self.__lock:
+                self.__blockchain_length = new_length
+            if new_length - self.__checkpoint_length >= EthereumStorage.CHECKPOINT_INTERVAL:
+                self.__write_checkpoint()
+        socketio.emit('refresh password')
+
+    def __merge(self, elements: List[Tuple[str, str]]):
+        with self.__lock:
+            applied = []
+            for k, v in elements:
+                print('loading:', k, v)
+                if self.load_key_value(k, v):
+                    applied.append((k, v))
+        for k, v in applied:
+            EthereumStorage.update_lookup_table(k, v)
+
+    def __write_checkpoint(self):
+        """
+        Writes a new checkpoint of the state of the mirror: the previous checkpoint updated with the entries after it.
+        The cache cannot be used, as it also has the local changes.
+        """
+        length, state = Settings().state_checkpoint
+        for k, v in Settings().iter_blockchain(length):
+            if v == '':
+                state.pop(k, None)
+            else:
+                state[k] = v
+        self.__checkpoint_length = Settings().blockchain_length
+        Settings().write_state_checkpoint(self.__checkpoint_length, state)
+
+    @staticmethod
+    def __sync_progress(loaded: int, total: int):
+        socketio.emit('sync progress', {'loaded': loaded, 'total': total})
+
     def terminate(self):
         self.__terminating = True
-        self.__load_thread.join()
-        self.__store_thread.join()
+        for scheduler in self.__schedulers.values():
+            scheduler.stop()
+        self.__warm_up_thread.join()
+        # the workers are not started if terminated while warming up
+        if self.__load_thread.ident is not None:
+            self.__load_thread.join()
+            for thread in self.__store_threads:
+                thread.join()
+        self.__journal.close()
 
     def __del__(self):
-        self.terminate()
+        try:
+            self.terminate()
+        except AttributeError:
+            # the constructor raised before the workers were created, e.g. the journal is in use
+            pass
+
+    @property
+    def flush_metrics(self) -> dict:
+        """
+        The decisions of the flush scheduler of each priority, see `FlushScheduler.metrics`.
+        """
+        return {priority: scheduler.metrics for priority, scheduler in self.__schedulers.items()}
+
+    @property
+    def ready(self) -> bool:
+        return self.__ready.is_set() and self.__load_error is None
 
     @property
-    def loaded(self):
-        return self.__loaded
+    def loaded(self) -> bool:
+        return self.__loaded.is_set()
+
+    @property
+    def failed(self) -> bool:
+        """
+        Whether loading the mirror failed, the storage cannot be used then.
+        """
+        return self.__load_error is not None
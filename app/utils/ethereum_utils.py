@@ -1,41 +1,375 @@
 import hashlib
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from typing import Callable, Optional
+from itertools import islice
+from threading import Thread, Condition, Lock
+from typing import Callable, Optional, Iterator, Tuple, List, Iterable, Dict, Set
 
-from web3 import Web3
+from eth_abi import decode_abi
+from eth_utils import decode_hex, encode_hex, keccak
+from web3 import Web3, IPCProvider
 from web3.contract import Contract
+from web3.exceptions import BadFunctionCallOutput
 from web3.eth import Eth
 from web3.miner import Miner
 from web3.personal import Personal
 
-from app.utils.decorators import set_state, check_state, check_and_unset_state
+from app.utils.decorators import set_state, check_state, check_and_unset_state, pooled
+from app.utils.exceptions import IncompleteResponseError
+from app.utils.gas_model import GasModel
+from app.utils.ipc import BatchClient, ConnectionPool
 from app.utils.misc import Singleton, HashType, Address
 
 
+Entries = List[Tuple[str, str]]
+
+
+def pack_entries(entries: Iterable[Tuple[str, str]]) -> bytes:
+    """
+    Packs `(key, value)` entries the way the `range` and `add_batch` functions of the storage contract do: each field
+    is utf-8 encoded and prefixed by its length as a 4-byte big-endian integer.
+    """
+    result = []
+    for entry in entries:
+        for field in entry:
+            field = field.encode()
+            result.append(len(field).to_bytes(4, 'big'))
+            result.append(field)
+    return b''.join(result)
+
+
+def unpack_entries(packed: bytes) -> Entries:
+    """
+    Reverse of `pack_entries`.
+    """
+    fields = []
+    offset = 0
+    while offset < len(packed):
+        size = int.from_bytes(packed[offset:offset + 4], 'big')
+        fields.append(packed[offset + 4:offset + 4 + size].decode())
+        offset += 4 + size
+    return list(zip(fields[0::2], fields[1::2]))
+
+
+class TransactionTracker:
+    """
+    Waits for pending transactions with a block filter: each time new blocks arrive, the receipts of all pending
+    transactions are queried in a single batch. Runs in a daemon thread, which makes no calls while nothing is pending.
+    """
+
+    def __init__(self, ethereum_utils: 'EthereumUtils', poll_interval: float = 0.5):
+        self.__ethereum_utils = ethereum_utils
+        self.__poll_interval = poll_interval
+        # callbacks of the pending transactions, and transactions added since the last check
+        self.__pending: Dict[HashType, List[Callable[[HashType, dict], None]]] = {}
+        self.__new: Set[HashType] = set()
+        self.__condition = Condition()
+        self.__filter_id = None
+        self.__thread = None
+
+    def track(self, transaction_hash: HashType, callback: Callable[[HashType, dict], None]):
+        """
+        Calls `callback(transaction_hash, receipt)` from the tracker thread once the transaction is mined.
+        """
+        with self.__condition:
+            self.__pending.setdefault(transaction_hash, []).append(callback)
+            self.__new.add(transaction_hash)
+            if self.__thread is None:
+                self.__thread = Thread(target=self.worker, daemon=True)
+                self.__thread.start()
+            self.__condition.notify()
+
+    def untrack(self, transaction_hash: HashType, callback: Callable[[HashType, dict], None] = None):
+        """
+        Stops waiting for the transaction with `callback`, or with all its callbacks if `callback` is not set.
+        """
+        with self.__condition:
+            callbacks = self.__pending.get(transaction_hash, [])
+            if callback is None:
+                callbacks.clear()
+            elif callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.__pending.pop(transaction_hash, None)
+                self.__new.discard(transaction_hash)
+
+    def wait(self, transaction_hashes: Iterable[HashType], callback: Callable[[HashType, dict], None] = None,
+             timeout: float = None) -> Set[HashType]:
+        """
+        Blocks until all `transaction_hashes` are mined or `timeout` seconds have passed. `callback` is called for
+        each transaction as soon as its block arrives.
+
+        :return: the transactions not mined within the time, which are not tracked anymore
+        """
+        unfinished = set(transaction_hashes)
+        finished = Condition()
+
+        def on_mined(transaction_hash: HashType, receipt: dict):
+            if callback:
+                callback(transaction_hash, receipt)
+            with finished:
+                unfinished.discard(transaction_hash)
+                finished.notify()
+
+        for transaction_hash in list(unfinished):
+            self.track(transaction_hash, on_mined)
+        with finished:
+            finished.wait_for(lambda: not unfinished, timeout)
+            unfinished = set(unfinished)
+        for transaction_hash in unfinished:
+            self.untrack(transaction_hash, on_mined)
+        return unfinished
+
+    def worker(self):
+        while True:
+            with self.__condition:
+                while not self.__pending:
+                    if self.__filter_id is not None:
+                        self.__ethereum_utils.uninstall_filter(self.__filter_id)
+                        self.__filter_id = None
+                    self.__condition.wait()
+                self.__condition.wait(self.__poll_interval)
+                pending = list(self.__pending)
+                new, self.__new = list(self.__new), set()
+            try:
+                if self.__filter_id is None:
+                    # blocks may have arrived before the filter is installed, check everything once
+                    self.__filter_id = self.__ethereum_utils.new_block_filter()
+                    self.__check(pending)
+                elif self.__ethereum_utils.get_filter_changes(self.__filter_id):
+                    self.__check(pending)
+                elif new:
+                    # the transaction may have been mined before it was tracked
+                    self.__check(new)
+            except Exception as e:
+                # the filter may have expired, a new one is installed on the next round
+                print(e)
+                self.__filter_id = None
+
+    def __check(self, transaction_hashes: List[HashType]):
+        receipts = self.__ethereum_utils.get_transaction_receipts(transaction_hashes)
+        for transaction_hash, receipt in zip(transaction_hashes, receipts):
+            if receipt:
+                with self.__condition:
+                    callbacks = self.__pending.pop(transaction_hash, [])
+                for callback in callbacks:
+                    callback(transaction_hash, receipt)
+
+
+class NonceManager:
+    """
+    Reserves transaction nonces locally for each account, so that transactions can be sent one after another (or from
+    several threads) without the node assigning nonces. The nonces are resynchronized with the pending transaction
+    count of the node when a transaction is rejected because of its nonce. The transactions sent are kept until mined,
+    so that one dropped by the node can be sent again to fill the gap it leaves, and so are the nonces of failed sends
+    that could not be handed back.
+    """
+
+    def __init__(self, ethereum_utils: 'EthereumUtils'):
+        self.__ethereum_utils = ethereum_utils
+        self.__lock = Lock()
+        self.__next: Dict[Address, int] = {}
+        # nonce -> (send function, transaction hash) of the transactions not known to be mined
+        self.__sent: Dict[Address, Dict[int, Tuple[Callable[[int], HashType], HashType]]] = {}
+        # nonces reserved by failed sends while later ones were in use, to be filled with empty transactions
+        self.__released: Dict[Address, Set[int]] = {}
+
+    def transact(self, account: Address, send: Callable[[int], HashType]) -> HashType:
+        """
+        Calls `send(nonce)` with the next nonce of `account` to send a transaction.
+
+        :return: the transaction hash returned by `send`
+        """
+        for retry in (False, True):
+            nonce = self.__reserve(account)
+            try:
+                transaction_hash = send(nonce)
+            except ValueError as e:
+                if not retry and NonceManager.is_nonce_error(e):
+                    # the nonces of the account have been used outside of this manager
+                    self.resync(account)
+                    continue
+                self.__release(account, nonce)
+                raise
+            except Exception:
+                self.__release(account, nonce)
+                raise
+            with self.__lock:
+                self.__sent.setdefault(account, {})[nonce] = (send, transaction_hash)
+            return transaction_hash
+
+    def resync(self, account: Address):
+        """
+        Continues from the pending transaction count of `account` on the node.
+        """
+        count = self.__ethereum_utils.get_transaction_count(account, 'pending')
+        with self.__lock:
+            self.__next[account] = count
+            # the nonces from the count on are reserved again
+            self.__released[account] = {nonce for nonce in self.__released.get(account, ()) if nonce < count}
+
+    def refill_gaps(self, account: Address) -> Dict[HashType, HashType]:
+        """
+        Sends again the transactions of `account` the node does not know anymore (e.g. dropped from its pool), and
+        fills the nonces released by failed sends with empty transactions, so that the later transactions can be mined.
+        The other nonces not mined yet were not used by this manager (e.g. before a restart), they are left alone.
+
+        :return: the new hash of each transaction sent again, by its old hash
+        """
+        mined = self.__ethereum_utils.get_transaction_count(account, 'latest')
+        with self.__lock:
+            sent = self.__sent.setdefault(account, {})
+            for nonce in [nonce for nonce in sent if nonce < mined]:
+                del sent[nonce]
+            released = self.__released.setdefault(account, set())
+            released.difference_update([nonce for nonce in released if nonce < mined])
+            lost = sorted(released)
+            transactions = sorted(sent.items())
+
+        for nonce in lost:
+            try:
+                self.__ethereum_utils.send_empty_transaction(account, nonce)
+            except ValueError as e:
+                if not NonceManager.is_nonce_error(e):
+                    raise
+                # the nonce has been used meanwhile
+            with self.__lock:
+                released.discard(nonce)
+
+        resent = {}
+        for nonce, (send, transaction_hash) in transactions:
+            if self.__ethereum_utils.get_transaction(transaction_hash) is not None:
+                continue
+            try:
+                new_hash = send(nonce)
+            except ValueError as e:
+                if not NonceManager.is_nonce_error(e):
+                    raise
+                # mined meanwhile, or known to the node again
+                continue
+            with self.__lock:
+                sent[nonce] = (send, new_hash)
+            resent[transaction_hash] = new_hash
+        return resent
+
+    @staticmethod
+    def is_nonce_error(e: ValueError) -> bool:
+        message = str(e).lower()
+        return 'nonce' in message or 'known transaction' in message or 'underpriced' in message
+
+    def __reserve(self, account: Address) -> int:
+        if account not in self.__next:
+            self.resync(account)
+        with self.__lock:
+            nonce = self.__next[account]
+            self.__next[account] = nonce + 1
+            return nonce
+
+    def __release(self, account: Address, nonce: int):
+        with self.__lock:
+            released = self.__released.setdefault(account, set())
+            if self.__next.get(account) != nonce + 1:
+                # later nonces are in use, the gap is filled by `refill_gaps`
+                released.add(nonce)
+                return
+            # handed back, together with the released nonces right below it
+            while nonce - 1 in released:
+                nonce -= 1
+                released.discard(nonce)
+            self.__next[account] = nonce
+
+
 class EthereumUtils(metaclass=Singleton):
-    def __init__(self, web3: Web3 = None):
+    # number of chain elements fetched by each batch request of `get_history`, and batch requests run concurrently
+    HISTORY_BATCH_SIZE = 100
+    HISTORY_CONCURRENCY = 4
+    # upper bound of the size of the packed elements returned by one `range` call of the storage contract
+    RANGE_RESPONSE_SIZE = 32 * 1024
+    # topic of the `Added(uint256 indexed index, string key, string value)` event of the storage contract
+    ADDED_TOPIC = encode_hex(keccak(b'Added(uint256,string,string)'))
+    # number of blocks covered by each `eth_getLogs` query
+    LOG_BLOCK_RANGE = 5000
+    # gas budget of a batch add transaction, below the target gas limit of the chain (4000000), and the offline model
+    # used to pack entries into batches: gas per entry, and per 32-byte word of the keys and values
+    BATCH_GAS_LIMIT = 3600000
+    BATCH_ENTRY_GAS = 70000
+    BATCH_WORD_GAS = 26000
+    ADD_BATCH_SELECTOR = encode_hex(keccak(b'add_batch(bytes)')[:4])
+
+    def __init__(self, web3: Web3 = None, ipc_path: str = None, pool_size: int = 4):
+        """
+        If `ipc_path` (the IPC socket `web3` is connected to) is given, up to `pool_size` connections to it are used
+        concurrently by different threads, and reads of many elements are sent as JSON-RPC batch requests through it.
+        """
         if web3 is None:
             raise ValueError('`web3` should not be None when first initialized')
-        self.__web3 = web3
-        self.__eth: Eth = web3.eth
-        self.__personal: Personal = web3.personal
-        self.__miner: Miner = web3.miner
+        if ipc_path:
+            self._connections = ConnectionPool(lambda: Web3(IPCProvider(ipc_path)), pool_size, web3)
+        else:
+            self._connections = ConnectionPool(None, 1, web3)
+        self.__batch_client = BatchClient(ipc_path) if ipc_path else None
+        # whether the storage contract at an address has the `range` view, contracts deployed before it do not
+        self.__range_support = {}
+        self.__event_support = {}
+        self.__batch_support = None
+        self.__transaction_tracker = TransactionTracker(self)
+        self.__nonces = NonceManager(self)
+        # gas model of `add`, with the address of the storage factory it was calibrated against
+        self.__gas_model: Tuple[str, GasModel] = None
+        self.__gas_model_lock = Lock()
+        # contract objects of each connection by address, and storage contract addresses by account
+        self.__contracts: Dict[Tuple[int, str], Contract] = {}
+        self.__storage_addresses: Dict[Address, str] = {}
 
         self.__is_mining = False
-        self.__storage_factory: Contract = None
+        self.__storage_factory_address = None
+        self.__storage_factory_abi = None
         self.__storage_abi = None
 
         self._contracts_initialized = False
         self._account_unlocked = False
 
+    @property
+    def __eth(self) -> Eth:
+        return self._connections.current().eth
+
+    @property
+    def __personal(self) -> Personal:
+        return self._connections.current().personal
+
+    @property
+    def __miner(self) -> Miner:
+        return self._connections.current().miner
+
+    @property
+    def __storage_factory(self) -> Contract:
+        return self.__contract(self.__storage_factory_address, self.__storage_factory_abi)
+
+    def __contract(self, address: str, abi) -> Contract:
+        """
+        Returns the contract at `address` bound to the connection checked out by the current thread.
+        """
+        connection = self._connections.current()
+        contract = self.__contracts.get((id(connection), address))
+        if contract is None:
+            contract = connection.eth.contract(address=address, abi=abi)
+            self.__contracts[(id(connection), address)] = contract
+        return contract
+
+    def __bind(self, storage: Contract) -> Contract:
+        return self.__contract(storage.address, self.__storage_abi)
+
     # Mining Operations
 
+    @pooled
     def start_mining(self, account, num_threads=1):
         self.__miner.setEtherBase(account)
         self.__miner.start(num_threads)
         self.__is_mining = True
 
+    @pooled
     def stop_mining(self):
         self.__miner.stop()
         self.__is_mining = False
@@ -48,7 +382,8 @@ class EthereumUtils(metaclass=Singleton):
 
     @set_state('_contracts_initialized')
     def init_contracts(self, storage_factory_address, storage_factory_abi, storage_abi):
-        self.__storage_factory = self.__eth.contract(address=storage_factory_address, abi=storage_factory_abi)
+        self.__storage_factory_address = storage_factory_address
+        self.__storage_factory_abi = storage_factory_abi
         self.__storage_abi = storage_abi
 
     @check_state('_contracts_initialized')
@@ -58,7 +393,9 @@ class EthereumUtils(metaclass=Singleton):
         Creates a new `Storage` contract for the `account`
         :return: None if the transaction is mined within the time, or transaction hash if timeout
         """
-        transaction_hash = self.__storage_factory.transact({'from': account}).new_storage()
+        with self._connections.connection():
+            transaction_hash = self.__nonces.transact(
+                account, lambda nonce: self.__storage_factory.transact({'from': account, 'nonce': nonce}).new_storage())
         return self.__wait_transaction(transaction_hash, timeout)
 
     @check_state('_contracts_initialized')
@@ -70,11 +407,13 @@ class EthereumUtils(metaclass=Singleton):
 
         :return: None if the transaction is mined within the time, or transaction hash if timeout
         """
-        transaction_hash = self.__storage_factory.transact({'from': account}).add(key, value)
+        with self._connections.connection():
+            transaction_hash = self.add_async(account, key, value)
         return self.__wait_transaction(transaction_hash, timeout)
 
     @check_state('_contracts_initialized')
     @check_state('_account_unlocked')
+    @pooled
     def add_async(self, account: HashType, key: str, value: str = '') -> HashType:
         """
         Store data to the ethereum network in a asynchronous manner
@@ -82,56 +421,280 @@ class EthereumUtils(metaclass=Singleton):
 
         :return: transaction hash
         """
-        transaction_hash = self.__storage_factory.transact({'from': account}).add(key, value)
-        return transaction_hash
+        return self.__nonces.transact(
+            account, lambda nonce: self.__storage_factory.transact({'from': account, 'nonce': nonce}).add(key, value))
 
     @check_state('_contracts_initialized')
+    @check_state('_account_unlocked')
+    @pooled
+    def add_batch_async(self, account: Address, entries: Entries,
+                        gas_limit: int = BATCH_GAS_LIMIT) -> List[Tuple[Entries, HashType]]:
+        """
+        Store many entries to the ethereum network in a asynchronous manner, in as few transactions as fit under
+        `gas_limit`. For deletion, set the value to ''. If the storage factory has no `add_batch` function, sends one
+        transaction per entry.
+
+        :return: the entries sent by each transaction, with its transaction hash
+        """
+        if not self.has_add_batch():
+            return [([(k, v)], self.add_async(account, k, v)) for k, v in entries]
+        result = []
+        for batch in self.pack_batches(entries, gas_limit):
+            result.extend(self.__send_batch(account, batch, gas_limit))
+        return result
+
+    def __send_batch(self, account: Address, batch: Entries, gas_limit: int) -> List[Tuple[Entries, HashType]]:
+        if len(batch) > 1:
+            # the offline model may be off, check the batch with the node and split it if it does not fit
+            gas = self.__storage_factory.estimateGas({'from': account}).add_batch(pack_entries(batch))
+            if gas > gas_limit:
+                middle = len(batch) // 2
+                return (self.__send_batch(account, batch[:middle], gas_limit) +
+                        self.__send_batch(account, batch[middle:], gas_limit))
+        packed = pack_entries(batch)
+        transaction_hash = self.__nonces.transact(
+            account, lambda nonce: self.__storage_factory.transact({'from': account, 'nonce': nonce}).add_batch(packed))
+        return [(batch, transaction_hash)]
+
+    @staticmethod
+    def pack_batches(entries: Iterable[Tuple[str, str]], gas_limit: int = BATCH_GAS_LIMIT) -> List[Entries]:
+        """
+        Splits `entries` into batches whose estimated gas fits under `gas_limit`, keeping their order.
+        """
+        batches = []
+        batch = []
+        batch_gas = 0
+        for k, v in entries:
+            words = sum((len(field.encode()) + 31) // 32 + 1 for field in (k, v))
+            gas = EthereumUtils.BATCH_ENTRY_GAS + EthereumUtils.BATCH_WORD_GAS * words
+            if batch and batch_gas + gas > gas_limit:
+                batches.append(batch)
+                batch = []
+                batch_gas = 0
+            batch.append((k, v))
+            batch_gas += gas
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @pooled
+    def has_add_batch(self) -> bool:
+        """
+        Whether the deployed storage factory has the `add_batch` function.
+        """
+        if self.__batch_support is None:
+            code = self.__eth.getCode(self.__storage_factory.address)
+            if isinstance(code, bytes):
+                code = encode_hex(code)
+            # the selector is pushed as a constant by the function dispatcher
+            self.__batch_support = EthereumUtils.ADD_BATCH_SELECTOR[2:] in code.lower()
+            if not self.__batch_support:
+                print('The storage factory at %s has no add_batch (deployed from an outdated storage_factory.bin), '
+                      'every change is sent in its own transaction' % self.__storage_factory.address)
+        return self.__batch_support
+
+    @check_state('_contracts_initialized')
+    @pooled
     def get_storage(self, account: Address) -> Contract:
         """
         Returns the `Storage` contract of the `account`
         """
-        storage_address = self.__storage_factory.call().storage_address(account)
-        return self.__eth.contract(address=storage_address, abi=self.__storage_abi)
+        storage_address = self.__storage_addresses.get(account)
+        if storage_address is None:
+            storage_address = self.__storage_factory.call().storage_address(account)
+            # no storage has been created yet for the account
+            if int(storage_address, 16) != 0:
+                self.__storage_addresses[account] = storage_address
+        return self.__contract(storage_address, self.__storage_abi)
 
     @check_state('_contracts_initialized')
+    @pooled
     def get_element(self, account: Address, index: int, kv: int, storage: Contract = None) -> str:
-        if storage is None:
-            storage = self.get_storage(account)
+        storage = self.get_storage(account) if storage is None else self.__bind(storage)
         return storage.call().data(index, kv)
 
     @check_state('_contracts_initialized')
+    @pooled
     def get_length(self, account: Address, storage: Contract = None) -> int:
-        if storage is None:
-            storage = self.get_storage(account)
+        storage = self.get_storage(account) if storage is None else self.__bind(storage)
         return storage.call().length()
 
     @check_state('_contracts_initialized')
-    def get_history(self, account: Address, from_: int = 0, storage: Contract = None):
+    def get_history(self, account: Address, from_: int = 0, storage: Contract = None, to: int = None,
+                    progress: Callable[[int, int], None] = None) -> Iterator[Tuple[str, str]]:
+        """
+        Yields the `(key, value)` elements of the storage of `account` from index `from_` to `to` (the current length
+        by default) in chain order, while the later elements are still being fetched. The elements are fetched with
+        the `range` view of the storage contract, or for contracts deployed without it, in batch requests of
+        `data` calls, a few of them concurrently. After each chunk, `progress(loaded, total)` is called if given.
+        """
         if storage is None:
             storage = self.get_storage(account)
-        length = self.get_length(account, storage)
-        data = []
-        for i in range(from_, length):
-            key = self.get_element(account, i, 0, storage)
-            value = self.get_element(account, i, 1, storage)
-            data.append((key, value))
-        return data
+        if to is None:
+            to = self.get_length(account, storage)
+        total = max(to - from_, 0)
+
+        if from_ < to and self.__supports_range(storage, from_):
+            i = from_
+            while i < to:
+                elements = self.get_range(account, i, to, storage)
+                if not elements:
+                    # the contract answered the probe, the node may be behind the length it reported
+                    raise IncompleteResponseError('Could not read range of the storage at %s' % storage.address)
+                yield from elements
+                i += len(elements)
+                if progress:
+                    progress(i - from_, total)
+            return
+
+        if self.__batch_client is None:
+            for i in range(from_, to):
+                yield self.get_element(account, i, 0, storage), self.get_element(account, i, 1, storage)
+                if progress:
+                    progress(i + 1 - from_, total)
+            return
+
+        batches = ((i, min(i + EthereumUtils.HISTORY_BATCH_SIZE, to))
+                   for i in range(from_, to, EthereumUtils.HISTORY_BATCH_SIZE))
+        loaded = 0
+        with ThreadPoolExecutor(EthereumUtils.HISTORY_CONCURRENCY) as executor:
+            pending = deque(executor.submit(self.__get_elements, storage, start, end)
+                            for start, end in islice(batches, EthereumUtils.HISTORY_CONCURRENCY))
+            while pending:
+                elements = pending.popleft().result()
+                for start, end in islice(batches, 1):
+                    pending.append(executor.submit(self.__get_elements, storage, start, end))
+                yield from elements
+                loaded += len(elements)
+                if progress:
+                    progress(loaded, total)
+
+    @check_state('_contracts_initialized')
+    @pooled
+    def get_range(self, account: Address, start: int, end: int, storage: Contract = None) -> Entries:
+        """
+        Returns the elements of the storage of `account` from index `start`, up to `end` or until the response
+        reaches `RANGE_RESPONSE_SIZE` bytes, whichever comes first (at least one element if `start < end`) in a single
+        call. Only works with storage contracts that have the `range` view.
+        """
+        storage = self.get_storage(account) if storage is None else self.__bind(storage)
+        packed = storage.call().range(start, end, EthereumUtils.RANGE_RESPONSE_SIZE)
+        if isinstance(packed, str):
+            packed = packed.encode('latin-1')
+        return unpack_entries(packed)
+
+    @pooled
+    def __supports_range(self, storage: Contract, index: int) -> bool:
+        if storage.address not in self.__range_support:
+            try:
+                self.__range_support[storage.address] = len(self.__bind(storage).call().range(index, index + 1, 0)) > 0
+            except (BadFunctionCallOutput, ValueError):
+                self.__range_support[storage.address] = False
+            if not self.__range_support[storage.address]:
+                print('The storage at %s has no range view (deployed from an outdated storage_factory.bin), its '
+                      'elements are read one by one' % storage.address)
+        return self.__range_support[storage.address]
+
+    def __get_elements(self, storage: Contract, start: int, end: int) -> List[Tuple[str, str]]:
+        calls = [('eth_call', [{'to': storage.address, 'data': storage.encodeABI('data', [i, kv])}, 'latest'])
+                 for i in range(start, end) for kv in (0, 1)]
+        results = []
+        for result in self.__batch_client.request(calls):
+            if result in (None, '0x'):
+                raise self.__missing_element_error(storage)
+            value = decode_abi(['string'], decode_hex(result))[0]
+            results.append(value.decode() if isinstance(value, bytes) else value)
+        return list(zip(results[0::2], results[1::2]))
+
+    def __missing_element_error(self, storage: Contract) -> Exception:
+        """
+        Returns the error for an element that could not be read: `BadFunctionCallOutput` if there is no contract at the
+        address of the storage, otherwise `IncompleteResponseError`, as the node may not have caught up yet.
+        """
+        code = self.__batch_client.request([('eth_getCode', [storage.address, 'latest'])])[0]
+        if code in (None, '0x'):
+            return BadFunctionCallOutput('No storage contract at %s' % storage.address)
+        return IncompleteResponseError('Could not read element of the storage at %s' % storage.address)
+
+    @pooled
+    def has_added_event(self, storage: Contract) -> bool:
+        """
+        Whether the storage contract emits `Added` events that `get_added` can sync from. Contracts deployed before
+        the event was introduced do not, and neither can be queried without the IPC batch client.
+        """
+        if self.__batch_client is None:
+            return False
+        if storage.address not in self.__event_support:
+            # the topic is pushed as a constant by the code emitting the event
+            code = self.__eth.getCode(storage.address)
+            if isinstance(code, bytes):
+                code = encode_hex(code)
+            self.__event_support[storage.address] = EthereumUtils.ADDED_TOPIC[2:] in code.lower()
+            if not self.__event_support[storage.address]:
+                print('The storage at %s has no Added event (deployed from an outdated storage_factory.bin), it is '
+                      'synced by polling its length' % storage.address)
+        return self.__event_support[storage.address]
+
+    def get_added(self, storage: Contract, from_block: int, to_block: int) -> List[Tuple[int, str, str]]:
+        """
+        Returns the `(index, key, value)` of the `Added` events emitted by the storage contract in the blocks from
+        `from_block` to `to_block` (inclusive), sorted by index. The block range is split into `LOG_BLOCK_RANGE`
+        queries sent as a single batch request.
+        """
+        calls = [('eth_getLogs', [{
+            'fromBlock': hex(start),
+            'toBlock': hex(min(start + EthereumUtils.LOG_BLOCK_RANGE - 1, to_block)),
+            'address': storage.address,
+            'topics': [EthereumUtils.ADDED_TOPIC]
+        }]) for start in range(from_block, to_block + 1, EthereumUtils.LOG_BLOCK_RANGE)]
+        added = []
+        for logs in self.__batch_client.request(calls):
+            for log in logs:
+                if log.get('removed'):
+                    continue
+                key, value = decode_abi(['string', 'string'], decode_hex(log['data']))
+                added.append((int(log['topics'][1], 16),
+                              key.decode() if isinstance(key, bytes) else key,
+                              value.decode() if isinstance(value, bytes) else value))
+        return sorted(added)
+
+    @pooled
+    def get_block_number(self) -> int:
+        return self.__eth.blockNumber
 
     @check_state('_contracts_initialized')
+    @pooled
     def estimate_new_storage_cost(self, account: Address) -> int:
         return self.__storage_factory.estimateGas({'from': account}).new_storage()
 
     @check_state('_contracts_initialized')
+    @pooled
     def estimate_add_cost(self, account: Address, key: str, value: str = '') -> int:
         return self.__storage_factory.estimateGas({'from': account}).add(key, value)
 
+    @check_state('_contracts_initialized')
+    def model_add_cost(self, account: Address, key: str, value: str = '') -> Tuple[int, float]:
+        """
+        Estimates the gas of `add` with the offline `GasModel`, which is calibrated against the node the first time
+        and whenever the storage factory address changes.
+
+        :return: the estimated gas and the relative error of the model
+        """
+        with self.__gas_model_lock:
+            if self.__gas_model is None or self.__gas_model[0] != self.__storage_factory_address:
+                model = GasModel(lambda k, v: self.estimate_add_cost(account, 'k' * k, 'v' * v))
+                self.__gas_model = (self.__storage_factory_address, model)
+        return self.__gas_model[1].estimate(len(key.encode()), len(value.encode()))
+
     # Account operations
 
+    @pooled
     def new_account(self, password: str) -> Address:
         return self.__personal.newAccount(hashlib.sha256(password.encode()).hexdigest())
 
     # TODO: maybe better to manage the duration ourselves (i.e. set duration to 0)
     @set_state('_account_unlocked', 'duration', 600)
+    @pooled
     def unlock_account(self, account: Address, password: str, guard=None, duration: int = 600):
         # guard=None here ensures duration must be passed as keyword arguments
         if guard is not None:
@@ -139,27 +702,79 @@ class EthereumUtils(metaclass=Singleton):
         password = hashlib.sha256(password.encode()).hexdigest()
         self.__personal.unlockAccount(account, password, duration)
 
+    @pooled
     def lock_account(self, account: Address):
         self.__personal.lockAccount(account)
 
+    @pooled
     def get_balance(self, account: Address) -> int:
         return self.__eth.getBalance(account)
 
     # Utilities
 
+    @pooled
     def get_transaction_receipt(self, transaction_hash):
         return self.__eth.getTransactionReceipt(transaction_hash)
 
+    def get_transaction_receipts(self, transaction_hashes: List[HashType]) -> List[Optional[dict]]:
+        """
+        Returns the receipts of `transaction_hashes` (`None` for pending ones), in a single batch request if possible.
+        """
+        if self.__batch_client is None:
+            return [self.get_transaction_receipt(transaction_hash) for transaction_hash in transaction_hashes]
+        return self.__batch_client.request([('eth_getTransactionReceipt', [transaction_hash])
+                                            for transaction_hash in transaction_hashes])
+
+    def wait_transactions(self, transaction_hashes: Iterable[HashType],
+                          callback: Callable[[HashType, dict], None] = None, timeout: float = None) -> Set[HashType]:
+        """
+        Waits for the transactions to be mined, see `TransactionTracker.wait`.
+
+        :return: the transactions not mined within the time
+        """
+        return self.__transaction_tracker.wait(transaction_hashes, callback, timeout)
+
+    @pooled
+    def get_transaction(self, transaction_hash: HashType) -> Optional[dict]:
+        return self.__eth.getTransaction(transaction_hash)
+
+    @pooled
+    def get_transaction_count(self, account: Address, block: str = 'latest') -> int:
+        return self.__eth.getTransactionCount(account, block)
+
+    @pooled
+    def send_empty_transaction(self, account: Address, nonce: int) -> HashType:
+        return self.__eth.sendTransaction({'from': account, 'to': account, 'value': 0, 'nonce': nonce})
+
+    @pooled
+    def refill_nonce_gaps(self, account: Address) -> Dict[HashType, HashType]:
+        """
+        See `NonceManager.refill_gaps`. The transactions replaced are not tracked anymore, the new ones are to be
+        waited for instead.
+        """
+        resent = self.__nonces.refill_gaps(account)
+        for transaction_hash in resent:
+            self.__transaction_tracker.untrack(transaction_hash)
+        return resent
+
+    @pooled
+    def new_block_filter(self):
+        return self.__eth.filter('latest').filter_id
+
+    @pooled
+    def get_filter_changes(self, filter_id) -> list:
+        return self.__eth.getFilterChanges(filter_id)
+
+    @pooled
+    def uninstall_filter(self, filter_id):
+        try:
+            self.__eth.uninstallFilter(filter_id)
+        except Exception as e:
+            print(e)
+
     def __wait_transaction(self, transaction_hash: HashType, timeout: int):
-        i = 0
-        sleep_time = 0.1
-        while True:
-            if self.__eth.getTransactionReceipt(transaction_hash):
-                return
-            time.sleep(sleep_time)
-            i += 1
-            if i > timeout * (1 / sleep_time):
-                return transaction_hash
+        if self.wait_transactions([transaction_hash], timeout=timeout):
+            return transaction_hash
 
 
 def initialize_ethereum_account(master_password_in_memory: str) -> Address:
@@ -1,2 +1,10 @@
 class StateError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class ChainIntegrityError(Exception):
+    pass
+
+
+class IncompleteResponseError(Exception):
+    pass
@@ -0,0 +1,186 @@
+import time
+from threading import Condition
+from typing import Callable, Dict, Iterable, Optional
+
+
+class FlushScheduler:
+    """
+    Decides when the pending changes of a storage are flushed: once no change has been made for `idle_delay` seconds,
+    once `max_count` keys or `max_bytes` bytes are pending, or `max_delay` seconds after the oldest pending change,
+    whichever comes first. Changes are tracked per key, so repeated changes to a key are only flushed once.
+
+    The storage reports its changes with `changed`, `cancel` and `skip`, and the keys it flushes with `take`. A worker
+    thread blocks in `wait` until a flush is due.
+    """
+
+    REASONS = ('idle', 'count', 'bytes', 'max_delay', 'terminate')
+
+    def __init__(self, idle_delay: float = 2, max_delay: float = 15, max_count: int = 100,
+                 max_bytes: int = 16 * 1024, clock: Callable[[], float] = time.monotonic):
+        self.__idle_delay = idle_delay
+        self.__max_delay = max_delay
+        self.__max_count = max_count
+        self.__max_bytes = max_bytes
+        self.__clock = clock
+
+        self.__condition = Condition()
+        # approximate size in bytes of the pending change of each key
+        self.__sizes: Dict[str, int] = {}
+        self.__bytes = 0
+        self.__first_change: Optional[float] = None
+        self.__last_change: Optional[float] = None
+        self.__stopped = False
+
+        self.__flushes = {reason: 0 for reason in FlushScheduler.REASONS}
+        self.__flushed_keys = 0
+        self.__coalesced = 0
+        self.__cancelled = 0
+        self.__skipped = 0
+        self.__max_pending_time = 0.0
+
+    def changed(self, key: str, size: int):
+        """
+        Records a change to `key` of about `size` bytes, replacing the pending change to the same key if any.
+        """
+        with self.__condition:
+            now = self.__clock()
+            old_size = self.__sizes.get(key)
+            if old_size is not None:
+                self.__coalesced += 1
+                self.__bytes -= old_size
+            self.__sizes[key] = size
+            self.__bytes += size
+            if self.__first_change is None:
+                self.__first_change = now
+            self.__last_change = now
+            self.__condition.notify_all()
+
+    def cancel(self, key: str):
+        """
+        Records that the pending change to `key` has been cancelled by a later change (e.g. an added key deleted, or a
+        value changed back to the persisted one).
+        """
+        with self.__condition:
+            if self.__discard(key):
+                self.__cancelled += 1
+
+    def discard(self, key: str):
+        """
+        Forgets the pending change to `key`, e.g. when it is overwritten by the network.
+        """
+        with self.__condition:
+            self.__discard(key)
+
+    def skip(self):
+        """
+        Records a change that did not need to be flushed, as it did not change the persisted value.
+        """
+        with self.__condition:
+            self.__skipped += 1
+
+    def take(self, keys: Optional[Iterable[str]] = None):
+        """
+        Records that the pending changes to `keys`, or all of them, are being flushed. The changes left pending stay
+        due if they were.
+        """
+        with self.__condition:
+            if self.__first_change is not None:
+                self.__max_pending_time = max(self.__max_pending_time, self.__clock() - self.__first_change)
+            if keys is None:
+                self.__flushed_keys += len(self.__sizes)
+                self.__reset()
+                return
+            for key in keys:
+                if self.__discard(key):
+                    self.__flushed_keys += 1
+
+    def due(self) -> Optional[str]:
+        """
+        Returns why a flush is due now, `None` if it is not.
+        """
+        with self.__condition:
+            return self.__due(self.__clock())
+
+    def wait(self) -> str:
+        """
+        Blocks until a flush is due, and returns why (one of `REASONS`). The pending changes are only cleared by
+        `take`, so a flush should follow.
+        """
+        with self.__condition:
+            while True:
+                now = self.__clock()
+                reason = self.__due(now)
+                if reason is not None:
+                    self.__flushes[reason] += 1
+                    return reason
+                if self.__sizes:
+                    self.__condition.wait(min(self.__first_change + self.__max_delay,
+                                              self.__last_change + self.__idle_delay) - now)
+                else:
+                    self.__condition.wait()
+
+    def wait_empty(self):
+        """
+        Blocks until no change is pending, or the scheduler is stopped.
+        """
+        with self.__condition:
+            while self.__sizes and not self.__stopped:
+                self.__condition.wait()
+
+    def stop(self):
+        """
+        Makes `wait` return 'terminate' from now on, so that the remaining changes are flushed.
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+
+    @property
+    def metrics(self) -> dict:
+        """
+        The decisions of the scheduler so far: the number of flushes by reason, the number of keys flushed, of changes
+        coalesced with a pending change to the same key, cancelled or skipped, the longest time a change waited to be
+        flushed, and the changes pending now.
+        """
+        with self.__condition:
+            return {
+                'flushes': dict(self.__flushes),
+                'flushed_keys': self.__flushed_keys,
+                'coalesced': self.__coalesced,
+                'cancelled': self.__cancelled,
+                'skipped': self.__skipped,
+                'max_pending_time': self.__max_pending_time,
+                'pending_keys': len(self.__sizes),
+                'pending_bytes': self.__bytes
+            }
+
+    def __due(self, now: float) -> Optional[str]:
+        if self.__stopped:
+            return 'terminate'
+        if not self.__sizes:
+            return None
+        if len(self.__sizes) >= self.__max_count:
+            return 'count'
+        if self.__bytes >= self.__max_bytes:
+            return 'bytes'
+        if now - self.__first_change >= self.__max_delay:
+            return 'max_delay'
+        if now - self.__last_change >= self.__idle_delay:
+            return 'idle'
+        return None
+
+    def __discard(self, key: str) -> bool:
+        size = self.__sizes.pop(key, None)
+        if size is None:
+            return False
+        self.__bytes -= size
+        if not self.__sizes:
+            self.__reset()
+        return True
+
+    def __reset(self):
+        self.__sizes = {}
+        self.__bytes = 0
+        self.__first_change = None
+        self.__last_change = None
+        self.__condition.notify_all()
@@ -0,0 +1,82 @@
+from typing import Callable, List, Tuple, Dict
+
+
+def storage_slots(length: int) -> int:
+    """
+    Number of storage slots taken by a string of `length` bytes: none if empty, one if it fits with its length, or a
+    slot for the length and one per 32 bytes.
+    """
+    if length == 0:
+        return 0
+    if length <= 31:
+        return 1
+    return 1 + (length + 31) // 32
+
+
+def _solve(a: List[List[float]], b: List[float]) -> List[float]:
+    """
+    Solves the linear system `a x = b` by Gaussian elimination with partial pivoting.
+    """
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda row: abs(m[row][column]))
+        m[column], m[pivot] = m[pivot], m[column]
+        for row in range(column + 1, n):
+            factor = m[row][column] / m[column][column]
+            for i in range(column, n + 1):
+                m[row][i] -= factor * m[column][i]
+    x = [0.0] * n
+    for row in reversed(range(n)):
+        x[row] = (m[row][n] - sum(m[row][i] * x[i] for i in range(row + 1, n))) / m[row][row]
+    return x
+
+
+class GasModel:
+    """
+    Linear model of the gas used by `StorageFactory.add` from the byte lengths of the key and the value: a fixed cost,
+    a cost per storage slot written and a cost per byte of call data. It is fitted once by least squares to gas
+    estimates of the node for a few lengths, after which estimates need no calls to the node.
+    """
+
+    # (key length, value length) of the calls measured to fit the model
+    CALIBRATION_LENGTHS = ((1, 0), (1, 1), (8, 31), (8, 32), (16, 64), (32, 100), (32, 200), (64, 500), (1, 1000))
+    # estimates are cached by ranges of this many bytes of call data
+    BUCKET_SIZE = 32
+
+    def __init__(self, measure: Callable[[int, int], int]):
+        """
+        `measure(key_length, value_length)` returns the gas estimated by the node for keys and values of these lengths.
+        """
+        samples = [(GasModel.features(k, v), measure(k, v)) for k, v in GasModel.CALIBRATION_LENGTHS]
+        n = len(samples[0][0])
+        normal = [[sum(x[i] * x[j] for x, _ in samples) for j in range(n)] for i in range(n)]
+        target = [sum(x[i] * y for x, y in samples) for i in range(n)]
+        self.__coefficients = _solve(normal, target)
+        # relative error of the model on the calibration calls
+        self.__error = max(abs(self.__predict(x) - y) / y for x, y in samples)
+        self.__cache: Dict[Tuple[int, int], int] = {}
+
+    @staticmethod
+    def features(key_length: int, value_length: int) -> Tuple[int, int, int]:
+        return 1, storage_slots(key_length) + storage_slots(value_length), key_length + value_length
+
+    def estimate(self, key_length: int, value_length: int) -> Tuple[int, float]:
+        """
+        Returns the estimated gas for a key and a value of these byte lengths, and the relative error of the model.
+        Estimates are cached by the storage slots written and the call data length rounded up to `BUCKET_SIZE`.
+        """
+        slots = storage_slots(key_length) + storage_slots(value_length)
+        bucket = (slots, -(-(key_length + value_length) // GasModel.BUCKET_SIZE))
+        gas = self.__cache.get(bucket)
+        if gas is None:
+            gas = int(round(self.__predict((1, slots, bucket[1] * GasModel.BUCKET_SIZE))))
+            self.__cache[bucket] = gas
+        return gas, self.__error
+
+    @property
+    def error(self) -> float:
+        return self.__error
+
+    def __predict(self, x: Tuple[int, ...]) -> float:
+        return sum(c * f for c, f in zip(self.__coefficients, x))
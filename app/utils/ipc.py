@@ -0,0 +1,137 @@
+import json
+import queue
+from contextlib import contextmanager
+from threading import Lock, local
+from typing import List, Tuple, Any, Callable
+
+from web3.providers.ipc import get_ipc_socket
+
+
+class BatchClient:
+    """
+    Sends JSON-RPC batch requests over the IPC socket of the node, so that many calls cost a single round trip. Each
+    request uses its own connection, so requests from different threads can run concurrently.
+    """
+
+    def __init__(self, ipc_path: str, timeout: float = 10):
+        self.__ipc_path = ipc_path
+        self.__timeout = timeout
+
+    def request(self, calls: List[Tuple[str, list]]) -> List[Any]:
+        """
+        Sends the `(method, params)` pairs in `calls` as one batch.
+
+        :return: the results, in the order of `calls`
+        :raise: `ValueError` if any of the calls failed, `socket.timeout` if the node does not answer in time
+        """
+        if not calls:
+            return []
+        payload = [{
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": i
+        } for i, (method, params) in enumerate(calls)]
+
+        connection = get_ipc_socket(self.__ipc_path, self.__timeout)
+        try:
+            connection.sendall(json.dumps(payload).encode())
+            response = self.__receive(connection)
+        finally:
+            connection.close()
+
+        results = [None] * len(calls)
+        for item in response:
+            if 'error' in item:
+                raise ValueError(item['error'])
+            results[item['id']] = item['result']
+        return results
+
+    @staticmethod
+    def __receive(connection) -> list:
+        chunks = []
+        while True:
+            # a timeout propagates, the connection is closed by the caller
+            chunk = connection.recv(65536)
+            if not chunk:
+                raise ConnectionError('IPC connection closed before the response was complete')
+            chunks.append(chunk)
+            # the response is only complete when it parses, only try when it may end here
+            if chunk.rstrip().endswith(b']'):
+                try:
+                    return json.loads(b''.join(chunks).decode())
+                except ValueError:
+                    pass
+
+
+class ConnectionPool:
+    """
+    Pool of up to `size` connections created by `factory` when needed. A thread checks out a connection for the
+    duration of `with pool.connection()`, and waits if all of them are checked out. Nested checkouts in the same thread
+    reuse the connection already checked out. A connection whose checkout ends with an `OSError` (e.g. a broken socket
+    or a timeout) is thrown away, and a new one is created in its place when needed.
+    """
+
+    def __init__(self, factory: Callable[[], Any], size: int, first: Any = None):
+        """
+        `first` is an existing connection to put in the pool.
+        """
+        self.__factory = factory
+        self.__size = size
+        self.__idle = queue.LifoQueue()
+        self.__created = 0
+        self.__lock = Lock()
+        self.__local = local()
+        if first is not None:
+            self.__idle.put(first)
+            self.__created = 1
+
+    @contextmanager
+    def connection(self):
+        current = getattr(self.__local, 'connection', None)
+        if current is not None:
+            yield current
+            return
+        connection = self.__checkout()
+        self.__local.connection = connection
+        broken = False
+        try:
+            yield connection
+        except OSError:
+            # the first connection cannot be replaced without a factory
+            broken = self.__factory is not None
+            raise
+        finally:
+            self.__local.connection = None
+            # `None` stands for a free slot
+            self.__idle.put(None if broken else connection)
+
+    def current(self) -> Any:
+        """
+        Returns the connection checked out by the current thread.
+        """
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            raise RuntimeError('No connection is checked out by the current thread')
+        return connection
+
+    def __checkout(self) -> Any:
+        try:
+            connection = self.__idle.get_nowait()
+        except queue.Empty:
+            with self.__lock:
+                create = self.__created < self.__size
+                if create:
+                    self.__created += 1
+            connection = None if create else self.__idle.get()
+        if connection is None:
+            try:
+                connection = self.__factory()
+            except Exception:
+                self.__idle.put(None)
+                raise
+        return connection
+
+    @property
+    def size(self) -> int:
+        return self.__size
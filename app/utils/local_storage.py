@@ -1,72 +1,325 @@
 import ctypes
 import json
+import mmap
 import os
 import platform
+import struct
 import sys
 import time
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, Future
+from threading import Thread, RLock, Event, Condition
 from pathlib import Path
-from typing import Optional, Union, Tuple
+from typing import Optional, Union, Tuple, Iterable, Dict, List, Iterator
 
-from app.utils.misc import hash_dict
+from app.utils.exceptions import ChainIntegrityError
+from app.utils.misc import hash_block, hash_dict, iter_json_array, LRUCache, Priority, StorageEntry
+
+
+def _hash_blocks(blocks: List[dict]) -> List[Tuple[str, Optional[str]]]:
+    """
+    For each block, returns its hash and, for blocks written by older versions (without a stored hash), also the sorted
+    JSON hash that older versions used to link the next block. Runs in the verification pool.
+    """
+    return [(hash_block(block["pre_block"], block["arguments"]["key"], block["arguments"]["value"]),
+             hash_dict(block) if "hash" not in block else None) for block in blocks]
+
+
+class _ChainVerifier:
+    """
+    Checks the hash links of a chain whose blocks are fed one at a time, so the chain never has to be held in memory.
+    Blocks are hashed in chunks, in a process pool once the chain turns out to be long, with a bounded number of chunks
+    in flight.
+    """
+
+    MAX_IN_FLIGHT = 8
+
+    def __init__(self, base_length: int, base_tip: str, checkpoint: Optional[dict]):
+        """
+        The chain starts after `base_length` blocks whose tip has the hash `base_tip` (the snapshot), or from the
+        genesis if `base_length` is 0. If `checkpoint` is set, the blocks covered by it are not checked again. If it
+        also has the `offset` of the last block it covers, `resume_offset` is set and the blocks should be fed from
+        this one.
+        """
+        self.__base_length = base_length
+        self.__start = 0
+        self.__checkpoint_hash = None
+        self.resume_offset = None
+        if checkpoint is not None and checkpoint["length"] > base_length:
+            self.__start = checkpoint["length"] - base_length
+            self.__checkpoint_hash = checkpoint["hash"]
+            self.resume_offset = checkpoint.get("offset")
+        # hash and sorted JSON hash of the block before the next one to check
+        self.__previous = (base_tip, None)
+        self.__count = 0 if self.resume_offset is None else self.__start - 1
+        self.__last_block = None
+        self.__last_offset = None
+        self.__base_tip = base_tip
+        self.__chunk = []
+        self.__pending = deque()
+        self.__executor = None
+        self.stale_checkpoint = False
+
+    def feed(self, block: dict, offset: int):
+        """
+        Feeds the next `block`, found at `offset` of the log.
+        """
+        index = self.__count
+        self.__count += 1
+        self.__last_block = block
+        self.__last_offset = offset
+        if index < self.__start:
+            if index == self.__start - 1:
+                block_hash = LocalStorage.block_hash(block)
+                self.stale_checkpoint = block_hash != self.__checkpoint_hash
+                self.__previous = (block_hash, hash_dict(block) if "hash" not in block else None)
+            return
+        self.__chunk.append(block)
+        if len(self.__chunk) >= LocalStorage.VERIFY_CHUNK_SIZE:
+            self.__submit()
+
+    def finish(self) -> Tuple[int, dict]:
+        """
+        Checks the remaining blocks.
+
+        :return: the number of blocks checked and the new checkpoint
+        :raise: `ChainIntegrityError` if the chain is broken
+        """
+        if self.__chunk:
+            self.__submit()
+        while self.__pending:
+            self.__check(*self.__pending.popleft())
+        if self.__executor is not None:
+            self.__executor.shutdown()
+        if self.__count < self.__start:
+            self.stale_checkpoint = True
+        checkpoint = {
+            "length": self.__base_length + self.__count,
+            "hash": LocalStorage.block_hash(self.__last_block) if self.__last_block else self.__base_tip
+        }
+        if self.__last_block:
+            checkpoint["offset"] = self.__last_offset
+        return max(self.__count - self.__start, 0), checkpoint
+
+    def __submit(self):
+        chunk, self.__chunk = self.__chunk, []
+        first = self.__count - len(chunk)
+        if self.__executor is None and first - self.__start >= LocalStorage.PARALLEL_VERIFY_THRESHOLD:
+            self.__executor = ProcessPoolExecutor()
+        if self.__executor is None:
+            self.__pending.append((first, chunk, _hash_blocks(chunk)))
+        else:
+            self.__pending.append((first, chunk, self.__executor.submit(_hash_blocks, chunk)))
+        while self.__pending and (isinstance(self.__pending[0][2], list) or
+                                  len(self.__pending) > _ChainVerifier.MAX_IN_FLIGHT):
+            self.__check(*self.__pending.popleft())
+
+    def __check(self, first: int, chunk: List[dict], hashes):
+        if isinstance(hashes, Future):
+            hashes = hashes.result()
+        for i, block in enumerate(chunk):
+            index = self.__base_length + first + i
+            block_hash, dict_hash = hashes[i]
+            if "hash" in block and block["hash"] != block_hash:
+                self.__fail('Block %d does not match its hash' % index)
+            if first + i == 0 or "hash" in block:
+                link = self.__previous[0]
+            else:
+                # blocks written by older versions link to the sorted JSON hash of the previous block
+                link = self.__previous[1]
+            if block["pre_block"] != link:
+                self.__fail('Block %d does not link to the previous block' % index)
+            self.__previous = (block_hash, dict_hash)
+
+    def __fail(self, message: str):
+        if self.__executor is not None:
+            for _, _, hashes in self.__pending:
+                hashes.cancel()
+            self.__executor.shutdown(wait=False)
+        raise ChainIntegrityError(message)
+
+
+# size of a block with empty key and value in the log (plus its newline, the pre_block and the block hash)
+_BLOCK_OVERHEAD = len(json.dumps({
+    "pre_block": '',
+    "arguments": {
+        "key": '',
+        "value": ''
+    },
+    "hash": ''
+})) + 1 + 64 * 2
+
+# cache entry of a persisted key whose value is only kept on disk (binary format), shared by all such keys
+_ON_DISK = StorageEntry(None, True)
 
 
 class LocalStorage:
-    def __init__(self, filename=None):
+    # chains with at least this many blocks to check are hashed in a process pool, in chunks of this size
+    PARALLEL_VERIFY_THRESHOLD = 4096
+    VERIFY_CHUNK_SIZE = 1024
+
+    # fsync policies of the background flusher
+    FSYNC_ALWAYS = 'always'  # every group commit is fsync'ed
+    FSYNC_ON_FLUSH = 'flush'  # only commits requested by `flush(wait=True)` are fsync'ed
+    FSYNC_NEVER = 'never'  # leave it to the OS
+
+    def __init__(self, filename=None, compact_ratio: Optional[float] = 2.0, compact_min_dead: int = 1000,
+                 binary: bool = False, cache_size: int = 4 * 1024 * 1024, flush_interval: Optional[float] = None,
+                 flush_size: int = 100, fsync_policy: str = FSYNC_ALWAYS, verify_on_load: bool = True):
         """
         Initialize the storage. If `filename` is not set or the targeting file does not exist,
         create a new database with empty storage, also create a new file for persistent storage.
         Otherwise load the contents from that file.
+
+        After each `store`, the storage is compacted automatically if the number of dead records (overwritten values
+        and deletions) on disk is at least `compact_min_dead` and at least `compact_ratio` times the number of live
+        keys. Set `compact_ratio` to `None` to disable automatic compaction.
+
+        If `binary` is `True`, the storage uses the memory-mapped binary format (see `BinaryDatabase`) in lazy mode:
+        only the keys, their persistence and their locations on disk are kept in memory. Persisted values are read
+        from the mapped file on `get`, through an LRU cache of hot values holding at most `cache_size` characters,
+        and `get_all` returns a view that reads the values while it is iterated.
+
+        If `flush_interval` is set, a background thread commits the pending changes in groups: at most
+        `flush_interval` seconds after a change, or as soon as `flush_size` changes are pending. `fsync_policy` is
+        one of `FSYNC_ALWAYS`, `FSYNC_ON_FLUSH` and `FSYNC_NEVER`. Use `flush` to wait for the changes to be written,
+        and `terminate` to stop the thread.
+
+        If `verify_on_load` is `True`, the blocks appended since the last verification are checked when loading (see
+        `verify`), and `ChainIntegrityError` is raised if the chain is broken.
         """
         self.__cache_dict = {}
 
         self.__change_set = set()
         self.__delete_set = set()
+        # keys whose value in the cache is not persisted, and the cost of the pending operations
+        self.__dirty = set()
+        self.__pending_cost = 0
+
+        self.__compact_ratio = compact_ratio
+        self.__compact_min_dead = compact_min_dead
+
+        self.__lock = RLock()
+        self.__terminating = False
+
+        self.__binary = binary
+        self.__hot_values = LRUCache(cache_size)
+        if binary:
+            self.__database = LocalStorage.BinaryDatabase(filename)
+            keys, self.__tip_hash, self.__blockchain_length, self.__disk_records = self.__database.load()
+            for k in keys:
+                self.__cache_dict[k] = _ON_DISK
+            if verify_on_load:
+                self.verify()
+        else:
+            self.__database = LocalStorage.Database(filename)
+            self.__load_log(verify_on_load)
+
+        self.__flush_interval = flush_interval
+        self.__flush_size = flush_size
+        self.__fsync_policy = fsync_policy
+        self.__flush_event = Event()
+        self.__flushed = Condition()
+        self.__flush_requested = 0
+        self.__flush_done = 0
+        self.__flush_error = None
+        self.__flush_stopped = False
+        self.__flush_thread = None
+        if flush_interval is not None:
+            self.__flush_thread = Thread(target=self.flush_worker, daemon=True)
+            self.__flush_thread.start()
+
+    def __load_log(self, verify: bool):
+        # blocks are streamed from the log into the cache (and the verifier), the chain is never held in memory
+        snapshot, blocks = self.__database.iter_chain()
+        verifier = self.__new_verifier(snapshot) if verify else None
+        if snapshot is None:
+            # Block 0 is the Genesis
+            offset, genesis = next(blocks)
+            if verifier:
+                verifier.feed(genesis, offset)
+            self.__tip_hash = LocalStorage.block_hash(genesis)
+            self.__blockchain_length = 1
+        else:
+            state = snapshot.pop("state")
+            while state:
+                k, v = state.popitem()
+                self.__cache_dict[k] = StorageEntry(v, True)
+            self.__tip_hash = snapshot["tip"]
+            self.__blockchain_length = snapshot["length"]
+        self.__disk_records = len(self.__cache_dict)
 
-        self.__database = LocalStorage.Database(filename)
-        blockchain = self.__database.read()
-        # Block 0 is the Genesis
-        for i in range(1, len(blockchain)):
-            element = blockchain[i]
+        element = None
+        for offset, element in blocks:
+            if verifier:
+                verifier.feed(element, offset)
             if element["arguments"]["value"] == "":
                 del self.__cache_dict[element["arguments"]["key"]]
             else:
-                self.__cache_dict[element["arguments"]["key"]] = (element["arguments"]["value"], True)
-        self.__blockchain = blockchain
+                self.__cache_dict[element["arguments"]["key"]] = StorageEntry(element["arguments"]["value"], True)
+            self.__disk_records += 1
+            self.__blockchain_length += 1
+        if element is not None:
+            self.__tip_hash = LocalStorage.block_hash(element)
+        if verifier:
+            self.__finish_verifier(verifier)
 
-    def add(self, k: str, v: str):
+    def add(self, k: str, v: str, priority: str = Priority.INTERACTIVE):
         """
         Add a new entry with key `k` and value `v` into the database. If the entry with key `k` exists,
         update its value with `v`. **This will not immediately write the underlying database.**
+
+        All changes are written together, `priority` is only accepted for compatibility with `EthereumStorage`.
         """
 
-        if k in self.__cache_dict and self.__cache_dict[k][1]:
-            self.__change_set.add(k)
-        elif k in self.__delete_set:
-            self.__delete_set.remove(k)
-            self.__change_set.add(k)
-        self.__cache_dict[k] = (v, False)
+        with self.__lock:
+            if k in self.__dirty:
+                self.__pending_cost -= LocalStorage.operation_cost(k, self.__cache_dict[k].value)
+            elif k in self.__cache_dict:
+                self.__change_set.add(k)
+            elif k in self.__delete_set:
+                self.__delete_set.remove(k)
+                self.__pending_cost -= LocalStorage.operation_cost(k)
+                self.__change_set.add(k)
+            self.__cache_dict[k] = StorageEntry(v, False)
+            self.__dirty.add(k)
+            self.__pending_cost += LocalStorage.operation_cost(k, v)
+            self.__hot_values.pop(k)
+            self.__changed()
 
-    def delete(self, k: str):
+    def delete(self, k: str, priority: str = Priority.INTERACTIVE):
         """
         Delete an entry in database with key `k`. If the key does not exist, an exception `KeyError` will be thrown.
         **This will not immediately write the underlying database.**
         """
 
-        if k in self.__cache_dict:
-            if not self.__cache_dict[k][1]:
-                if k in self.__change_set:
-                    # changed in cache
-                    self.__delete_set.add(k)
-                    del self.__cache_dict[k]
-                    self.__change_set.remove(k)
+        with self.__lock:
+            if k in self.__cache_dict:
+                self.__hot_values.pop(k)
+                if k in self.__dirty:
+                    self.__dirty.remove(k)
+                    self.__pending_cost -= LocalStorage.operation_cost(k, self.__cache_dict[k].value)
+                    if k in self.__change_set:
+                        # changed in cache
+                        self.__delete_set.add(k)
+                        self.__pending_cost += LocalStorage.operation_cost(k)
+                        del self.__cache_dict[k]
+                        self.__change_set.remove(k)
+                    else:
+                        # new in cache, not changed in cache
+                        del self.__cache_dict[k]
                 else:
-                    # new in cache, not changed in cache
+                    self.__delete_set.add(k)
+                    self.__pending_cost += LocalStorage.operation_cost(k)
                     del self.__cache_dict[k]
+                self.__changed()
             else:
-                self.__delete_set.add(k)
-                del self.__cache_dict[k]
-        else:
-            raise KeyError(k)
+                raise KeyError(k)
+
+    def __changed(self):
+        if self.__flush_thread is not None and len(self.__dirty) + len(self.__delete_set) >= self.__flush_size:
+            self.__flush_event.set()
 
     def get(self, k: str, check_persistence: bool = False) -> Union[Optional[str], Tuple[Optional[str], bool]]:
         """
@@ -77,13 +330,24 @@ class LocalStorage:
         `(None, None)`.
         """
 
-        result = self.__cache_dict.get(k, (None, None))
-        if check_persistence:
-            return result
-        else:
-            return result[0]
+        with self.__lock:
+            entry = self.__cache_dict.get(k)
+            if entry is None:
+                result = (None, None)
+            elif entry is _ON_DISK:
+                value = self.__hot_values.get(k)
+                if value is None:
+                    value = self.__database.read_value(k)
+                    self.__hot_values.put(k, value)
+                result = (value, True)
+            else:
+                result = (entry.value, entry.persisted)
+            if check_persistence:
+                return result
+            else:
+                return result[0]
 
-    def get_all(self) -> dict:
+    def get_all(self) -> Mapping:
         """
         Return all keys with their values and persistence in the database. The returned value should have a structure
         like this:
@@ -92,38 +356,220 @@ class LocalStorage:
             key: (value, persistence)
         }
 
+        In lazy mode (binary format), the returned value is a read-only mapping with the same structure, whose values
+        are read from disk one at a time while iterating.
         """
+        if self.__binary:
+            return LocalStorage.LazyView(self, self.__cache_dict, self.__lock)
         return self.__cache_dict
 
-    def store(self):
+    def store(self, fsync: bool = True):
         """
-        Synchronize the changes with underlying database.
+        Synchronize the changes with underlying database. If `fsync` is `False`, the written data is not forced to
+        the disk.
         """
 
-        # 1. filter the dirty items in the cache_dict (persistence == False), these are `add` operation
-        for k, v in self.__cache_dict.items():
-            if not v[1]:
-                self.__blockchain.append({
-                    "pre_block": hash_dict(self.__blockchain[-1]),
-                    "arguments": {
-                        "key": k,
-                        "value": v[0]
-                    }
-                })
-                self.__cache_dict[k] = (v[0], True)
-
-        # 2. items in delete_list are `del` operation
-        for k in self.__delete_set:
-            self.__blockchain.append({
-                "pre_block": hash_dict(self.__blockchain[-1]),
-                "arguments": {
-                    "key": k,
-                    "value": ""
-                }
-            })
-        self.__database.write(self.__blockchain)
-        self.__change_set = set()
-        self.__delete_set = set()
+        with self.__lock:
+            # the blocks are hashed against a local tip, the state only changes once they are written, so that a
+            # failed write leaves the changes pending
+            tip = self.__tip_hash
+            new_blocks = []
+
+            # 1. the dirty items in the cache_dict (persistence == False) are `add` operation
+            for k in self.__dirty:
+                new_blocks.append(LocalStorage.new_block(tip, k, self.__cache_dict[k].value))
+                tip = new_blocks[-1]["hash"]
+
+            # 2. items in delete_list are `del` operation
+            for k in self.__delete_set:
+                new_blocks.append(LocalStorage.new_block(tip, k, ''))
+                tip = new_blocks[-1]["hash"]
+
+            # only the new blocks are written, the history already in the log is untouched
+            if new_blocks:
+                self.__database.append(new_blocks, fsync)
+                self.__disk_records += len(new_blocks)
+            self.__tip_hash = tip
+            self.__blockchain_length += len(new_blocks)
+            for k in self.__dirty:
+                entry = self.__cache_dict[k]
+                if self.__binary:
+                    self.__cache_dict[k] = _ON_DISK
+                    self.__hot_values.put(k, entry.value)
+                else:
+                    entry.persisted = True
+            self.__change_set = set()
+            self.__delete_set = set()
+            self.__dirty = set()
+            self.__pending_cost = 0
+
+            if self.__compact_ratio is not None:
+                dead = self.__disk_records - len(self.__cache_dict)
+                if dead >= self.__compact_min_dead and dead >= self.__compact_ratio * len(self.__cache_dict):
+                    self.compact()
+
+    def compact(self):
+        """
+        Writes a snapshot of the latest value of every key together with the hash of the chain tip it covers, then
+        empties the log. Later loads start from the snapshot and only replay the blocks appended after it.
+        Pending changes are `store`d first.
+        """
+        with self.__lock:
+            if self.__dirty or self.__delete_set:
+                self.store()
+            state = ((k, self.get(k)) for k in self.__cache_dict)
+            self.__database.compact(state, self.__tip_hash, self.__blockchain_length)
+            self.__disk_records = len(self.__cache_dict)
+
+    def flush(self, wait: bool = True):
+        """
+        Commits the pending changes now. Without the background flusher, this is the same as `store`. Otherwise the
+        flusher is woken up, and if `wait` is `True`, this returns after the changes are written (and fsync'ed unless
+        the policy is `FSYNC_NEVER`). Once the flusher has been terminated, the changes are `store`d by the caller.
+        """
+        if self.__flush_thread is None:
+            self.store()
+            return
+        with self.__flushed:
+            if not self.__flush_stopped:
+                self.__flush_requested += 1
+                target = self.__flush_requested
+                self.__flush_event.set()
+                if not wait:
+                    return
+                self.__flushed.wait_for(lambda: self.__flush_done >= target or self.__flush_stopped)
+                if self.__flush_done >= target:
+                    if self.__flush_error is not None:
+                        error, self.__flush_error = self.__flush_error, None
+                        raise error
+                    return
+        self.store()
+
+    def flush_worker(self):
+        while True:
+            self.__flush_event.wait(self.__flush_interval)
+            self.__flush_event.clear()
+            with self.__flushed:
+                requested = self.__flush_requested
+            if self.__fsync_policy == LocalStorage.FSYNC_ALWAYS:
+                fsync = True
+            elif self.__fsync_policy == LocalStorage.FSYNC_ON_FLUSH:
+                fsync = requested > self.__flush_done or self.__terminating
+            else:
+                fsync = False
+            error = None
+            try:
+                # a failed store leaves the changes pending, they are written again by the next round
+                if self.__dirty or self.__delete_set:
+                    self.store(fsync)
+            except Exception as e:
+                print(e)
+                error = e
+            with self.__flushed:
+                self.__flush_done = requested
+                self.__flush_error = error
+                self.__flush_stopped = self.__terminating
+                self.__flushed.notify_all()
+            if self.__terminating:
+                return
+
+    def terminate(self):
+        """
+        Stops the background flusher after committing the pending changes.
+        """
+        if self.__flush_thread is not None:
+            self.__terminating = True
+            self.__flush_event.set()
+            self.__flush_thread.join()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        The chain is loaded by the constructor, so the storage is always ready.
+        """
+        return True
+
+    @property
+    def ready(self) -> bool:
+        return True
+
+    @property
+    def failed(self) -> bool:
+        return False
+
+    def verify(self) -> int:
+        """
+        Verifies the hash links of the whole chain on disk, from the genesis (or the snapshot if the storage has been
+        compacted), skipping the blocks already verified by an earlier call. Hashing is spread over a process pool
+        for long chains. The verified length, and the offset of the last verified block in the log, are persisted in
+        `./db/<filename>.verified` afterwards, the blocks before it are not even read by later calls.
+
+        :return: the number of blocks checked
+        :raise: `ChainIntegrityError` if a block does not match its hash or does not link to the previous block
+        """
+        with self.__lock:
+            snapshot, blocks = self.__database.iter_chain()
+            verifier = self.__new_verifier(snapshot)
+            if verifier.resume_offset is not None:
+                blocks = self.__database.read(verifier.resume_offset)
+            try:
+                for offset, block in blocks:
+                    verifier.feed(block, offset)
+            except ValueError:
+                if verifier.resume_offset is None:
+                    raise
+                # the offset is not the start of a block (any more), the whole chain is read again
+                verifier.stale_checkpoint = True
+            return self.__finish_verifier(verifier)
+
+    def __new_verifier(self, snapshot: Optional[dict]) -> _ChainVerifier:
+        checkpoint = None
+        if os.path.exists(self.__checkpoint_path()):
+            with open(self.__checkpoint_path(), 'r') as f:
+                checkpoint = json.load(f)
+        if snapshot is None:
+            return _ChainVerifier(0, '', checkpoint)
+        return _ChainVerifier(snapshot["length"], snapshot["tip"], checkpoint)
+
+    def __finish_verifier(self, verifier: _ChainVerifier) -> int:
+        checked, checkpoint = verifier.finish()
+        if verifier.stale_checkpoint:
+            # the chain has changed below the checkpoint, verify it again from the start
+            os.remove(self.__checkpoint_path())
+            return self.verify()
+        if checked or verifier.resume_offset is None and "offset" in checkpoint:
+            # only rewritten when more blocks have been verified, or to add the offset to an older checkpoint
+            with open(self.__checkpoint_path() + '.tmp', 'w') as f:
+                json.dump(checkpoint, f)
+            os.replace(self.__checkpoint_path() + '.tmp', self.__checkpoint_path())
+        return checked
+
+    def __checkpoint_path(self) -> str:
+        return './db/%s.verified' % self.__database.filename
+
+    @staticmethod
+    def new_block(pre_block: str, k: str, v: str) -> dict:
+        """
+        Builds a block on top of the block with hash `pre_block`. The hash of the new block is computed once here and
+        persisted with it.
+        """
+        return {
+            "pre_block": pre_block,
+            "arguments": {
+                "key": k,
+                "value": v
+            },
+            "hash": hash_block(pre_block, k, v)
+        }
+
+    @staticmethod
+    def block_hash(block: dict) -> str:
+        """
+        Returns the hash of `block`. Blocks written by older versions do not carry their hash, it is computed from the
+        canonical serialization in that case.
+        """
+        if "hash" in block:
+            return block["hash"]
+        return hash_block(block["pre_block"], block["arguments"]["key"], block["arguments"]["value"])
 
     def estimate_cost(self, args: dict) -> int:
         """
@@ -131,29 +577,24 @@ class LocalStorage:
         """
         block = {
             "pre_block": "",
-            "arguments": args
+            "arguments": args,
+            "hash": ""
         }
-        return (len(json.dumps(block)) + 64) * 8
+        return (len(json.dumps(block)) + 1 + 64 * 2) * 8
 
     def calculate_total_cost(self) -> int:
         """
         Calculates the cost of currently cached storage operations.
         """
-        fixed = len(json.dumps({
-            "pre_block": '',
-            "arguments": {
-                "key": '',
-                "value": ''
-            }
-        })) + 64
-        s = 0
-        for k, v in self.__cache_dict.items():
-            if not v[1]:
-                s += fixed + len(k) + len(v[0])
+        return self.__pending_cost
 
-        for k in self.__delete_set:
-            s += fixed + len(k)
-        return s
+    @staticmethod
+    def operation_cost(k: str, v: str = '') -> int:
+        """
+        Returns the cost of the block storing key `k` with value `v` (deletion if `v` is empty), in the same unit as
+        `calculate_total_cost`.
+        """
+        return _BLOCK_OVERHEAD + len(k) + len(v)
 
     def balance(self) -> int:
         """
@@ -189,7 +630,208 @@ class LocalStorage:
     def __len__(self):
         return self.size()
 
+    class LazyView(Mapping):
+        """
+        Read-only mapping of key to `(value, persistence)` over a lazy mode storage.
+        """
+
+        def __init__(self, storage: 'LocalStorage', cache_dict: dict, lock: RLock):
+            self.__storage = storage
+            self.__cache_dict = cache_dict
+            self.__lock = lock
+
+        def __getitem__(self, k):
+            result = self.__storage.get(k, True)
+            if result[1] is None:
+                raise KeyError(k)
+            return result
+
+        def __iter__(self):
+            # the keys are copied, so that the storage can be changed while iterating
+            with self.__lock:
+                keys = list(self.__cache_dict)
+            return iter(keys)
+
+        def __len__(self):
+            return len(self.__cache_dict)
+
     class Database:
+        """
+        The underlying database is an append-only log with one JSON encoded block per line, stored in
+        `./db/<filename>.chain`. Blocks are only ever appended, so the cost of a write depends on the number of new
+        blocks rather than the length of the whole chain.
+
+        After compaction, the state covered by the emptied log is kept in `./db/<filename>.snapshot`.
+        """
+
+        GENESIS = {
+            "pre_block": "",
+            "arguments": {
+                "key": "the answer to the life, the universe and everything",
+                "value": "42"
+            }
+        }
+
+        def __init__(self, filename):
+            """
+            Initialize the database. If `filename` is `None`, use the current time as the name for file.
+            Otherwise, use `filename` for the file.
+
+            If only a legacy `./db/<filename>.json` (the whole chain dumped as one JSON array) exists, it is converted
+            into the log format.
+            """
+            if filename:
+                self.__filename = filename
+            else:
+                self.__filename = 'tmp/' + str(int(time.time() * 1000))  # current millisecond
+            self.__path = './db/%s.chain' % self.__filename
+            self.__snapshot_path = './db/%s.snapshot' % self.__filename
+            if not os.path.exists(self.__path):
+                directory = Path(self.__path[:self.__path.rfind('/')])
+                directory.mkdir(parents=True, exist_ok=True)
+                legacy_path = './db/%s.json' % self.__filename
+                if os.path.exists(legacy_path):
+                    with open(legacy_path, 'r') as f:
+                        self.write(iter_json_array(f))
+                else:
+                    genesis = LocalStorage.Database.GENESIS
+                    self.write([LocalStorage.new_block(genesis["pre_block"],
+                                                       genesis["arguments"]["key"],
+                                                       genesis["arguments"]["value"])])
+
+        def write(self, data: Iterable[dict]):
+            """
+            Replaces the whole log with the blocks in `data`. The new log is written to a temporary file first and
+            then moved over the old one, so the log is never left half written.
+            """
+            tmp_path = self.__path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for block in data:
+                    f.write(json.dumps(block) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.__path)
+
+        def write_snapshot(self, snapshot: dict):
+            """
+            Writes the `snapshot` atomically, in the same way as `write`.
+            """
+            tmp_path = self.__snapshot_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.__snapshot_path)
+
+        def compact(self, state: Iterable[Tuple[str, str]], tip: str, length: int):
+            """
+            Replaces the log with a snapshot of `state` (pairs of key and latest value) that covers the chain up to the
+            block with hash `tip`, which is the `length`-th block.
+            """
+            self.write_snapshot({
+                "tip": tip,
+                "length": length,
+                "state": dict(state)
+            })
+            self.write([])
+
+        def read_snapshot(self) -> Optional[dict]:
+            """
+            Returns the snapshot, or `None` if the storage has never been compacted.
+            """
+            if not os.path.exists(self.__snapshot_path):
+                return None
+            with open(self.__snapshot_path, 'r') as f:
+                return json.load(f)
+
+        def append(self, blocks: list, fsync: bool = True):
+            """
+            Appends `blocks` to the end of the log and fsyncs once for the whole batch. If the write fails, the log is
+            cut back to its previous end.
+            """
+            end = os.path.getsize(self.__path) if os.path.exists(self.__path) else 0
+            try:
+                with open(self.__path, 'a') as f:
+                    f.write(''.join(json.dumps(block) + '\n' for block in blocks))
+                    f.flush()
+                    if fsync:
+                        os.fsync(f.fileno())
+            except Exception:
+                os.truncate(self.__path, end)
+                raise
+
+        def iter_chain(self) -> Tuple[Optional[dict], Iterator[Tuple[int, dict]]]:
+            """
+            Returns the snapshot (or `None`) and an iterator over the blocks of the chain after it, with their offsets
+            in the log. Without a snapshot, the blocks start from the genesis. Blocks are read from the log one at a
+            time.
+            """
+            snapshot = self.read_snapshot()
+            return snapshot, self.__iter_tail(snapshot)
+
+        def __iter_tail(self, snapshot: Optional[dict]) -> Iterator[Tuple[int, dict]]:
+            blocks = self.read()
+            if snapshot is not None:
+                # the log is emptied after the snapshot is written, if that did not happen, the log starts from an
+                # earlier block, skip the blocks covered by the snapshot
+                for offset, block in blocks:
+                    if block["pre_block"] == snapshot["tip"]:
+                        yield offset, block
+                        break
+                    if LocalStorage.block_hash(block) == snapshot["tip"]:
+                        break
+            yield from blocks
+
+        def read(self, offset: int = 0) -> Iterator[Tuple[int, dict]]:
+            """
+            Iterates over the blocks in the log from the one at `offset`, with their offsets. A trailing record that is
+            not terminated by a newline was torn by an interrupted append, it is ignored and cut off from the log so
+            that later appends start on a clean line.
+
+            :raise: `ValueError` if `offset` is not the start of a line
+            """
+            valid_size = offset
+            with open(self.__path, 'rb') as f:
+                if offset:
+                    f.seek(offset - 1)
+                    if f.read(1) != b'\n':
+                        raise ValueError('No block at %d' % offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    if line.strip():
+                        yield valid_size, json.loads(line.decode())
+                    valid_size += len(line)
+            if valid_size < os.path.getsize(self.__path):
+                with open(self.__path, 'r+b') as f:
+                    f.truncate(valid_size)
+
+        @property
+        def filename(self):
+            return self.__filename
+
+    class BinaryDatabase:
+        """
+        Binary alternative of `Database`. Blocks are stored in `./db/<filename>.bin` as length-prefixed records:
+
+            record = length + field(hash) + field(pre_block) + field(key) + field(value)
+            field  = length + utf-8 encoded string
+
+        where every length is a 4-byte big-endian unsigned integer. The files are read through `mmap`, and a side index
+        `./db/<filename>.idx` maps every live key to the location of its latest record, so loading only needs the index
+        (plus the records appended after it was written), and values are read one at a time on demand.
+
+        After compaction, the live key-value pairs are kept in `./db/<filename>.snap`, a file of `field(key) +
+        field(value)` records preceded by a `field(tip) + field(length)` record, and the block file is emptied.
+        """
+
+        # the index is rewritten after this many records have been appended without being indexed
+        INDEX_INTERVAL = 1024
+
+        # the files that a location can point into, a location is stored as the int `offset << 1 | segment`
+        SNAPSHOT = 0
+        LOG = 1
+
         def __init__(self, filename):
             """
             Initialize the database. If `filename` is `None`, use the current time as the name for file.
@@ -199,33 +841,290 @@ class LocalStorage:
                 self.__filename = filename
             else:
                 self.__filename = 'tmp/' + str(int(time.time() * 1000))  # current millisecond
-            whole_filename = './db/%s.json' % self.__filename
-            if not os.path.exists(whole_filename):
-                directory = Path(whole_filename[:whole_filename.rfind('/')])
+            self.__path = './db/%s.bin' % self.__filename
+            self.__snapshot_path = './db/%s.snap' % self.__filename
+            self.__index_path = './db/%s.idx' % self.__filename
+            if not os.path.exists(self.__path):
+                if any(os.path.exists('./db/%s.%s' % (self.__filename, ext)) for ext in ('chain', 'json')):
+                    raise ValueError('%s is stored in the log format' % self.__filename)
+                directory = Path(self.__path[:self.__path.rfind('/')])
                 directory.mkdir(parents=True, exist_ok=True)
-                with open(whole_filename, 'w') as f:
-                    json.dump([{
-                        "pre_block": "",
-                        "arguments": {
-                            "key": "the answer to the life, the universe and everything",
-                            "value": "42"
-                        }
-                    }], f)
+                genesis = LocalStorage.Database.GENESIS
+                genesis = LocalStorage.new_block(genesis["pre_block"],
+                                                 genesis["arguments"]["key"],
+                                                 genesis["arguments"]["value"])
+                with open(self.__path, 'wb') as f:
+                    f.write(self.encode_record(genesis["hash"], genesis["pre_block"],
+                                               genesis["arguments"]["key"], genesis["arguments"]["value"]))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            self.__maps = {}
+            self.__index: Dict[str, int] = {}
+            self.__log_size = 0
+            self.__snapshot_tip = ''
+            self.__tip = ''
+            self.__length = 0
+            self.__records = 0
+            self.__unindexed = 0
+
+        @staticmethod
+        def encode_record(*fields: str) -> bytes:
+            body = []
+            for field in fields:
+                field = field.encode()
+                body.append(struct.pack('>I', len(field)))
+                body.append(field)
+            body = b''.join(body)
+            return struct.pack('>I', len(body)) + body
+
+        @staticmethod
+        def decode_record(buffer, offset: int) -> Tuple[List[str], int]:
+            """
+            Decodes the record starting at `offset` of `buffer`.
+
+            :return: the fields of the record and the offset of the next record
+            :raise: `ValueError` if the record is truncated
+            """
+            if offset + 4 > len(buffer):
+                raise ValueError('Truncated record at %d' % offset)
+            size, = struct.unpack_from('>I', buffer, offset)
+            end = offset + 4 + size
+            if end > len(buffer):
+                raise ValueError('Truncated record at %d' % offset)
+            fields = []
+            position = offset + 4
+            while position < end:
+                if position + 4 > end:
+                    raise ValueError('Truncated field at %d' % position)
+                field_size, = struct.unpack_from('>I', buffer, position)
+                position += 4
+                fields.append(bytes(buffer[position:position + field_size]).decode())
+                position += field_size
+            return fields, end
+
+        def load(self) -> Tuple[List[str], str, int, int]:
+            """
+            Loads the index, rebuilding it from the snapshot and block files if it is missing or stale, and catches up
+            with the records appended after it was written.
+
+            :return: the live keys, the tip hash, the chain length and the number of records on disk
+            """
+            snapshot = self.__mapped(LocalStorage.BinaryDatabase.SNAPSHOT)
+            if snapshot:
+                (self.__snapshot_tip, length), snapshot_offset = self.decode_record(snapshot, 0)
+            log = self.__mapped(LocalStorage.BinaryDatabase.LOG)
+
+            index = None
+            if os.path.exists(self.__index_path):
+                with open(self.__index_path, 'r') as f:
+                    index = json.load(f)
+            if index is not None and index["snapshot_tip"] == self.__snapshot_tip and index["log_size"] <= len(log):
+                self.__index = index["keys"]
+                self.__tip = index["tip"]
+                self.__length = index["length"]
+                self.__records = index["records"]
+                offset = index["log_size"]
+            elif snapshot:
+                self.__tip = self.__snapshot_tip
+                self.__length = int(length)
+                while snapshot_offset < len(snapshot):
+                    position = snapshot_offset
+                    (k, _), snapshot_offset = self.decode_record(snapshot, position)
+                    self.__index[k] = position << 1 | LocalStorage.BinaryDatabase.SNAPSHOT
+                self.__records = len(self.__index)
+                # the block file is emptied after the snapshot is written, if that did not happen, skip the covered
+                # records
+                offset = 0
+                position = 0
+                while position < len(log):
+                    try:
+                        fields, position = self.decode_record(log, position)
+                    except ValueError:
+                        break
+                    if fields[0] == self.__tip:
+                        offset = position
+                        break
+            else:
+                # record 0 is the Genesis
+                fields, offset = self.decode_record(log, 0)
+                self.__tip = fields[0]
+                self.__length = 1
+
+            while offset < len(log):
+                try:
+                    (h, _, k, v), next_offset = self.decode_record(log, offset)
+                except ValueError:
+                    # torn by an interrupted append
+                    self.__close_maps()
+                    with open(self.__path, 'r+b') as f:
+                        f.truncate(offset)
+                    break
+                self.__apply(k, v, offset)
+                self.__tip = h
+                self.__length += 1
+                self.__records += 1
+                self.__unindexed += 1
+                offset = next_offset
+            self.__log_size = offset
+            return list(self.__index), self.__tip, self.__length, self.__records
 
-        def write(self, data: list):
+        def append(self, blocks: list, fsync: bool = True):
             """
-            Writes the data to the json file. If the file doesn't exist, produce a new file and write to it.
+            Appends `blocks` to the block file and fsyncs once for the whole batch. If the write fails, the file is
+            cut back to its previous end and the index is left untouched.
             """
-            with open('./db/%s.json' % self.__filename, 'w') as f:
-                json.dump(data, f)
+            records = [self.encode_record(block["hash"], block["pre_block"], block["arguments"]["key"],
+                                          block["arguments"]["value"]) for block in blocks]
+            try:
+                with open(self.__path, 'ab') as f:
+                    f.write(b''.join(records))
+                    f.flush()
+                    if fsync:
+                        os.fsync(f.fileno())
+            except Exception:
+                os.truncate(self.__path, self.__log_size)
+                raise
+            offset = self.__log_size
+            for block, record in zip(blocks, records):
+                self.__apply(block["arguments"]["key"], block["arguments"]["value"], offset)
+                offset += len(record)
+            self.__log_size = offset
+            self.__tip = blocks[-1]["hash"]
+            self.__length += len(blocks)
+            self.__records += len(blocks)
+            self.__unindexed += len(blocks)
+            if self.__unindexed >= LocalStorage.BinaryDatabase.INDEX_INTERVAL:
+                self.write_index()
 
-        def read(self) -> list:
+        def iter_chain(self) -> Tuple[Optional[dict], Iterator[Tuple[int, dict]]]:
             """
-            Returns the data in the json file.
+            Same as `Database.iter_chain`, the snapshot only has the `tip` and `length` entries.
             """
-            with open('./db/%s.json' % self.__filename, 'r') as f:
-                data = json.load(f)
-            return data
+            snapshot = None
+            if self.__snapshot_tip:
+                snapshot = {"tip": self.__snapshot_tip, "length": int(self.decode_record(
+                    self.__mapped(LocalStorage.BinaryDatabase.SNAPSHOT), 0)[0][1])}
+            return snapshot, self.__iter_tail(snapshot)
+
+        def __iter_tail(self, snapshot: Optional[dict]) -> Iterator[Tuple[int, dict]]:
+            skipping = snapshot is not None
+            for offset, block in self.read():
+                if skipping:
+                    # same as `Database`, skip the records covered by the snapshot if the block file was not emptied
+                    if block["hash"] == snapshot["tip"]:
+                        skipping = False
+                        continue
+                    if block["pre_block"] != snapshot["tip"]:
+                        continue
+                    skipping = False
+                yield offset, block
+
+        def read(self, offset: int = 0) -> Iterator[Tuple[int, dict]]:
+            """
+            Same as `Database.read`, only the records appended up to now are read.
+
+            :raise: `ValueError` if a record cannot be decoded, e.g. `offset` is not the start of one
+            """
+            log = self.__mapped(LocalStorage.BinaryDatabase.LOG, self.__log_size - 1)
+            while offset < self.__log_size:
+                (h, pre_block, k, v), next_offset = self.decode_record(log, offset)
+                yield offset, {
+                    "pre_block": pre_block,
+                    "arguments": {
+                        "key": k,
+                        "value": v
+                    },
+                    "hash": h
+                }
+                offset = next_offset
+
+        def read_value(self, k: str) -> Optional[str]:
+            """
+            Returns the latest value of key `k` read from the mapped files, or `None` if the key does not exist.
+            """
+            location = self.__index.get(k)
+            if location is None:
+                return None
+            segment, offset = location & 1, location >> 1
+            fields, _ = self.decode_record(self.__mapped(segment, offset), offset)
+            return fields[-1]
+
+        def compact(self, state: Iterable[Tuple[str, str]], tip: str, length: int):
+            """
+            Replaces the block file with a snapshot of `state` (pairs of key and latest value) that covers the chain up
+            to the block with hash `tip`, which is the `length`-th block.
+            """
+            index = {}
+            tmp_path = self.__snapshot_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                position = f.write(self.encode_record(tip, str(length)))
+                for k, v in state:
+                    index[k] = position << 1 | LocalStorage.BinaryDatabase.SNAPSHOT
+                    position += f.write(self.encode_record(k, v))
+                f.flush()
+                os.fsync(f.fileno())
+            self.__close_maps()
+            os.replace(tmp_path, self.__snapshot_path)
+            with open(self.__path + '.tmp', 'wb') as f:
+                os.fsync(f.fileno())
+            os.replace(self.__path + '.tmp', self.__path)
+
+            self.__index = index
+            self.__log_size = 0
+            self.__snapshot_tip = tip
+            self.__tip = tip
+            self.__length = length
+            self.__records = len(index)
+            self.write_index()
+
+        def write_index(self):
+            """
+            Writes the index of the records up to now, in the same way as `Database.write`.
+            """
+            tmp_path = self.__index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    "snapshot_tip": self.__snapshot_tip,
+                    "log_size": self.__log_size,
+                    "tip": self.__tip,
+                    "length": self.__length,
+                    "records": self.__records,
+                    "keys": self.__index
+                }, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.__index_path)
+            self.__unindexed = 0
+
+        def __apply(self, k: str, v: str, offset: int):
+            if v == '':
+                self.__index.pop(k, None)
+            else:
+                self.__index[k] = offset << 1 | LocalStorage.BinaryDatabase.LOG
+
+        def __mapped(self, segment: int, offset: int = 0):
+            """
+            Returns the mapping of `segment`, remapping it if `offset` lies beyond the mapped size (the file has grown
+            since). An empty or missing file maps to `b''`.
+            """
+            mapping = self.__maps.get(segment)
+            if mapping is None or offset >= len(mapping):
+                if mapping is not None:
+                    mapping.close()
+                    del self.__maps[segment]
+                path = self.__snapshot_path if segment == LocalStorage.BinaryDatabase.SNAPSHOT else self.__path
+                if not os.path.exists(path) or os.path.getsize(path) == 0:
+                    return b''
+                with open(path, 'rb') as f:
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.__maps[segment] = mapping
+            return mapping
+
+        def __close_maps(self):
+            for mapping in self.__maps.values():
+                mapping.close()
+            self.__maps = {}
 
         @property
         def filename(self):
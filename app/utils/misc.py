@@ -3,7 +3,9 @@ import hashlib
 import json
 import os
 import platform
-from typing import NewType, Union
+import struct
+from collections import OrderedDict
+from typing import NewType, Union, Optional, Iterator, TextIO
 
 
 def sha2(s: str) -> str:
@@ -14,6 +16,74 @@ def hash_dict(d: dict) -> str:
     return sha2(json.dumps(d, sort_keys=True))
 
 
+def iter_json_array(f: TextIO, chunk_size: int = 64 * 1024) -> Iterator:
+    """
+    Iterates over the elements of the JSON array in the file `f` without loading the whole array, reading the file
+    `chunk_size` characters at a time.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    position = 0
+    eof = False
+
+    def skip(chars: str):
+        nonlocal buffer, position, eof
+        while True:
+            while position < len(buffer) and buffer[position] in chars:
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            buffer, position = f.read(chunk_size), 0
+            eof = not buffer
+
+    skip(' \t\r\n')
+    if buffer[position:position + 1] != '[':
+        raise ValueError('Expected a JSON array')
+    position += 1
+    skip(' \t\r\n')
+    if buffer[position:position + 1] == ']':
+        return
+    while True:
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+            # a number may continue in the next chunk
+            if (end == len(buffer) or buffer[end] in '.eE+-') and not eof:
+                raise ValueError
+        except ValueError:
+            if eof:
+                raise
+            more = f.read(chunk_size)
+            eof = not more
+            buffer, position = buffer[position:] + more, 0
+            continue
+        yield element
+        position = end
+        skip(' \t\r\n')
+        if buffer[position:position + 1] == ']':
+            return
+        if buffer[position:position + 1] != ',':
+            raise ValueError('Expected "," or "]" in a JSON array')
+        position += 1
+        skip(' \t\r\n')
+
+
+def serialize_block(pre_block: str, key: str, value: str) -> bytes:
+    """
+    Canonical binary serialization of a block: each field is utf-8 encoded and prefixed by its length as a 4-byte
+    big-endian unsigned integer, in the order `pre_block`, `key`, `value`.
+    """
+    result = []
+    for field in (pre_block, key, value):
+        field = field.encode()
+        result.append(struct.pack('>I', len(field)))
+        result.append(field)
+    return b''.join(result)
+
+
+def hash_block(pre_block: str, key: str, value: str) -> str:
+    return hashlib.sha256(hashlib.sha256(serialize_block(pre_block, key, value)).digest()).hexdigest()
+
+
 class Singleton(type):
     _instances = {}
 
@@ -23,6 +93,92 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class StorageEntry:
+    """
+    Cache entry of a storage: the value of a key and whether it has been persisted. It has no `__dict__` and behaves
+    like the tuple `(value, persisted)` for indexing, unpacking and comparison.
+    """
+    __slots__ = ('value', 'persisted')
+
+    def __init__(self, value: Optional[str], persisted: bool):
+        self.value = value
+        self.persisted = persisted
+
+    def __getitem__(self, item: int):
+        if item == 0:
+            return self.value
+        if item == 1:
+            return self.persisted
+        raise IndexError(item)
+
+    def __iter__(self):
+        yield self.value
+        yield self.persisted
+
+    def __len__(self):
+        return 2
+
+    def __eq__(self, other):
+        if not isinstance(other, (StorageEntry, tuple)):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    # mutable, like a list
+    __hash__ = None
+
+    def __repr__(self):
+        return repr((self.value, self.persisted))
+
+
+class Priority:
+    """
+    Priority classes of storage writes. Interactive writes (a user editing a password) are sent first, bulk writes
+    (e.g. an import) are rate-limited so that they do not delay them.
+    """
+    INTERACTIVE = 'interactive'
+    BULK = 'bulk'
+
+
+class LRUCache:
+    """
+    Least recently used cache of string values, bounded by the total length of the cached values instead of the number
+    of entries.
+    """
+
+    def __init__(self, max_size: int):
+        self.__max_size = max_size
+        self.__size = 0
+        self.__items = OrderedDict()
+
+    def get(self, k: str) -> Optional[str]:
+        v = self.__items.get(k)
+        if v is not None:
+            self.__items.move_to_end(k)
+        return v
+
+    def put(self, k: str, v: str):
+        self.pop(k)
+        if len(v) > self.__max_size:
+            return
+        self.__items[k] = v
+        self.__size += len(v)
+        while self.__size > self.__max_size:
+            _, evicted = self.__items.popitem(last=False)
+            self.__size -= len(evicted)
+
+    def pop(self, k: str):
+        v = self.__items.pop(k, None)
+        if v is not None:
+            self.__size -= len(v)
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def __len__(self):
+        return len(self.__items)
+
+
 # string like '0x12345...'
 HashType = NewType('Hash', str)
 Address = HashType
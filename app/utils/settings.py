@@ -1,6 +1,7 @@
 import json
 import os
 from pathlib import Path
+from typing import Iterator, Tuple, List, Dict
 from unqlite import UnQLite
 
 from flask import current_app
@@ -56,12 +57,68 @@ class Settings(metaclass=Singleton):
         self.__db['blockchain_length'] = str(v)
 
     @property
-    def blockchain(self) -> list:
-        return json.loads(self.__db_get('blockchain', '[]'))
+    def blockchain_synced_block(self) -> int:
+        """
+        Number of the last ethereum block whose `Added` events have been applied to the mirror, -1 if none.
+        """
+        return int(self.__db_get('blockchain_synced_block', -1))
 
-    @blockchain.setter
-    def blockchain(self, v: list):
-        self.__db['blockchain'] = json.dumps(v)
+    @blockchain_synced_block.setter
+    def blockchain_synced_block(self, v: int):
+        self.__db['blockchain_synced_block'] = str(v)
+
+    @property
+    def blockchain(self) -> Iterator[Tuple[str, str]]:
+        """
+        Iterates over the `(key, value)` entries of the local mirror of the ethereum storage, in chain order. Each entry
+        is stored in its own record, `blockchain_length` is the number of entries.
+        """
+        return self.iter_blockchain()
+
+    def iter_blockchain(self, start: int = 0) -> Iterator[Tuple[str, str]]:
+        """
+        Iterates over the entries of the mirror from index `start`.
+        """
+        self.__migrate_blockchain()
+        for i in range(start, self.blockchain_length):
+            k, v = json.loads(self.__db['blockchain/%d' % i])
+            yield k, v
+
+    def append_blockchain(self, entries: List[Tuple[str, str]], start: int, end: int):
+        """
+        Writes `entries` as the entries of the mirror from index `start` to `end` (exclusive), and sets
+        `blockchain_length` to `end`. The records and the length are committed together.
+        """
+        if end - start != len(entries):
+            raise ValueError('%d entries for the indices %d to %d' % (len(entries), start, end))
+        self.__migrate_blockchain()
+        for i, (k, v) in enumerate(entries, start):
+            self.__db['blockchain/%d' % i] = json.dumps([k, v])
+        self.blockchain_length = end
+        self.write()
+
+    @property
+    def state_checkpoint(self) -> Tuple[int, Dict[str, str]]:
+        """
+        The materialized key -> value state of the first entries of the mirror, with the number of entries it covers.
+        """
+        return int(self.__db_get('state_checkpoint_length', 0)), json.loads(self.__db_get('state_checkpoint', '{}'))
+
+    def write_state_checkpoint(self, length: int, state: Dict[str, str]):
+        self.__db['state_checkpoint'] = json.dumps(state)
+        self.__db['state_checkpoint_length'] = str(length)
+        self.write()
+
+    def __migrate_blockchain(self):
+        # older versions stored the whole mirror as a single JSON list
+        if 'blockchain' in self.__db:
+            length = 0
+            for k, v in json.loads(self.__db['blockchain']):
+                self.__db['blockchain/%d' % length] = json.dumps([k, v])
+                length += 1
+            self.blockchain_length = length
+            del self.__db['blockchain']
+            self.write()
 
     def __del__(self):
         self.__db.close()
@@ -0,0 +1,175 @@
+import json
+import os
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from app.utils.exceptions import StateError
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+Entries = List[Tuple[str, str]]
+
+
+class WriteJournal:
+    """
+    Append-only journal of the changes of a storage that have not been persisted yet, so that they survive a crash or
+    a restart. Each record is a JSON list on its own line:
+
+    - `["w", key, value, priority]`: a change (`value` is '' for a deletion) waiting to be sent
+    - `["d", key]`: the pending change to `key` was dropped (reverted, cancelled or overwritten by the network)
+    - `["s", transaction_hash, entries]`: `entries` were sent by the transaction, the pending changes to the same
+      values are no longer pending
+    - `["r", old_hash, new_hash]`: the entries of a transaction were sent again by another one
+    - `["m", transaction_hash]`: the transaction was mined, or is lost and its entries are pending again
+
+    Replaying the journal gives the changes still pending and the transactions not mined yet. The journal is rewritten
+    with only these records when it is opened, and when it has grown to `COMPACT_RATIO` times as many records.
+
+    A journal can only be open once at a time, it is locked (through `<path>.lock`, as compacting replaces the journal
+    file) until it is closed.
+    """
+
+    COMPACT_MIN_RECORDS = 1000
+    COMPACT_RATIO = 4
+
+    def __init__(self, path: str, fsync: bool = True):
+        """
+        Opens the journal at `path`, replaying it if it exists. If `fsync` is `True`, every record is fsync'ed before
+        the call appending it returns.
+
+        :raise: `StateError` if the journal is already open
+        """
+        self.__path = path
+        self.__fsync = fsync
+        self.__lock = Lock()
+        self.__lock_file = WriteJournal.__acquire(path + '.lock')
+        self.__pending: Dict[str, Tuple[str, str]] = {}
+        self.__in_flight: Dict[str, Entries] = {}
+        self.__records = 0
+        self.__file = None
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last record may have been cut by a crash
+                        break
+                    self.__apply(record)
+        self.__compact()
+
+    @property
+    def pending(self) -> Dict[str, Tuple[str, str]]:
+        """
+        The pending changes, as `key -> (value, priority)`.
+        """
+        with self.__lock:
+            return dict(self.__pending)
+
+    @property
+    def in_flight(self) -> Dict[str, Entries]:
+        """
+        The entries of each transaction sent but not known to be mined.
+        """
+        with self.__lock:
+            return dict(self.__in_flight)
+
+    def write(self, k: str, v: str, priority: str):
+        if self.__pending.get(k) != (v, priority):
+            self.__append(['w', k, v, priority])
+
+    def drop(self, k: str):
+        if k in self.__pending:
+            self.__append(['d', k])
+
+    def sent(self, entries: Entries, transaction_hash: str):
+        self.__append(['s', transaction_hash, entries])
+
+    def resent(self, old_hash: str, new_hash: str):
+        if old_hash in self.__in_flight:
+            self.__append(['r', old_hash, new_hash])
+
+    def mined(self, transaction_hash: str):
+        if transaction_hash in self.__in_flight:
+            self.__append(['m', transaction_hash])
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            if self.__lock_file is not None:
+                # closing the file releases the lock
+                self.__lock_file.close()
+                self.__lock_file = None
+
+    @staticmethod
+    def __acquire(path: str):
+        lock_file = open(path, 'a')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            raise StateError('The journal %s is used by another storage' % path[:-len('.lock')])
+        return lock_file
+
+    def __apply(self, record: list):
+        op = record[0]
+        if op == 'w':
+            self.__pending[record[1]] = (record[2], record[3])
+        elif op == 'd':
+            self.__pending.pop(record[1], None)
+        elif op == 's':
+            entries = [(k, v) for k, v in record[2]]
+            for k, v in entries:
+                if self.__pending.get(k, (None,))[0] == v:
+                    del self.__pending[k]
+            self.__in_flight[record[1]] = entries
+        elif op == 'r':
+            entries = self.__in_flight.pop(record[1], None)
+            if entries is not None:
+                self.__in_flight[record[2]] = entries
+        elif op == 'm':
+            self.__in_flight.pop(record[1], None)
+        self.__records += 1
+
+    def __append(self, record: list):
+        with self.__lock:
+            if self.__file is None:
+                # closed with the storage (e.g. a transaction mined after terminating), nothing more is kept
+                return
+            self.__apply(record)
+            self.__file.write(json.dumps(record) + '\n')
+            self.__file.flush()
+            if self.__fsync:
+                os.fsync(self.__file.fileno())
+            live = len(self.__pending) + len(self.__in_flight)
+            if self.__records >= max(WriteJournal.COMPACT_MIN_RECORDS, WriteJournal.COMPACT_RATIO * live):
+                self.__compact()
+
+    def __compact(self):
+        """
+        Rewrites the journal with only the records of the pending changes and of the transactions in flight.
+        """
+        if self.__file is not None:
+            self.__file.close()
+        temp_path = self.__path + '.tmp'
+        with open(temp_path, 'w') as f:
+            # the transactions first, as their records drop the pending changes to the same values
+            for transaction_hash, entries in self.__in_flight.items():
+                f.write(json.dumps(['s', transaction_hash, entries]) + '\n')
+            for k, (v, priority) in self.__pending.items():
+                f.write(json.dumps(['w', k, v, priority]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.__path)
+        self.__records = len(self.__pending) + len(self.__in_flight)
+        self.__file = open(self.__path, 'a')
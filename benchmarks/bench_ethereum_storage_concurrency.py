@@ -0,0 +1,108 @@
+"""
+Measures the latency of `EthereumStorage.add` (what an API write waits for) while the storage syncs a long remote
+chain and flushes its changes in the background. The node is simulated with a fixed latency per request, so the
+numbers only depend on how long the storage holds its lock.
+
+Run from the project root:
+
+    python -m benchmarks.bench_ethereum_storage_concurrency
+"""
+import os
+import time
+
+from app import create_app, db
+from app.utils.ethereum_storage import EthereumStorage
+from app.utils.ethereum_utils import EthereumUtils
+from app.utils.misc import Singleton
+from app.utils.settings import Settings
+
+CHAIN_LENGTH = 20000
+# latency of a batch request reading `BATCH_SIZE` elements, and of sending a transaction
+READ_LATENCY = 0.01
+BATCH_SIZE = 100
+SEND_LATENCY = 0.05
+WRITES = 2000
+SETTINGS_FILE = 'db/bench_settings.db'
+JOURNAL_FILE = 'db/bench.journal'
+
+
+class SimulatedNode:
+    """
+    Stands in for `EthereumUtils`, serving a chain of `CHAIN_LENGTH` elements with the latencies above.
+    """
+
+    def __init__(self):
+        self.loaded = 0
+
+    def get_storage(self, account):
+        return None
+
+    def has_added_event(self, storage):
+        return False
+
+    def get_length(self, account, storage=None):
+        return CHAIN_LENGTH
+
+    def get_history(self, account, from_=0, storage=None, to=None, progress=None):
+        to = CHAIN_LENGTH if to is None else to
+        for start in range(from_, to, BATCH_SIZE):
+            time.sleep(READ_LATENCY)
+            for i in range(start, min(start + BATCH_SIZE, to)):
+                yield '__remote_%d' % i, 'v' * 88
+            self.loaded = min(start + BATCH_SIZE, to)
+
+    def unlock_account(self, account, password, guard=None, duration=600):
+        pass
+
+    def add_batch_async(self, account, entries, gas_limit=EthereumUtils.BATCH_GAS_LIMIT):
+        time.sleep(SEND_LATENCY)
+        return [(entries, '0x0')]
+
+    def wait_transactions(self, transaction_hashes, callback=None, timeout=None):
+        return set()
+
+    def get_transaction(self, transaction_hash):
+        return {}
+
+
+def percentile(samples: list, p: float) -> float:
+    return sorted(samples)[min(int(len(samples) * p), len(samples) - 1)]
+
+
+def measure(storage: EthereumStorage, prefix: str) -> list:
+    samples = []
+    for i in range(WRITES):
+        start = time.perf_counter()
+        storage.add('%s%d' % (prefix, i), 'x' * 88)
+        samples.append(time.perf_counter() - start)
+        time.sleep(0.001)
+    return samples
+
+
+def main():
+    for path in (SETTINGS_FILE, JOURNAL_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    app, _ = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        Settings(SETTINGS_FILE)
+        node = SimulatedNode()
+        Singleton._instances[EthereumUtils] = node
+
+        storage = EthereumStorage('0x0', 'password', JOURNAL_FILE)
+        during = measure(storage, 'during_')
+        print('remote elements loaded during the measurement: %d / %d' % (node.loaded, CHAIN_LENGTH))
+        while node.loaded < CHAIN_LENGTH:
+            time.sleep(0.1)
+        time.sleep(1)
+        idle = measure(storage, 'idle_')
+
+    print('%-12s %10s %10s %10s' % ('add()', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+    for name, samples in (('during sync', during), ('idle', idle)):
+        print('%-12s %10.3f %10.3f %10.3f' % (name, percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000,
+                                              max(samples) * 1000))
+
+
+if __name__ == '__main__':
+    main()
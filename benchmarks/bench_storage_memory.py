@@ -0,0 +1,67 @@
+"""
+Measures the memory taken by each cache entry of a storage, comparing the `(value, persisted)` tuples used before with
+`StorageEntry`, and a `LocalStorage` loaded from disk.
+
+Run from the project root:
+
+    python -m benchmarks.bench_storage_memory
+"""
+import gc
+import tracemalloc
+
+from app.utils.local_storage import LocalStorage
+from app.utils.misc import StorageEntry
+
+SIZES = (10000, 100000)
+# similar to an encrypted password entry encoded in base64
+VALUE_SIZE = 88
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def make_items(n: int) -> list:
+    return [('%016x' % i, 'v' * VALUE_SIZE + '%08d' % i) for i in range(n)]
+
+
+def main():
+    print('%-24s %10s %16s' % ('cache', 'entries', 'bytes per entry'))
+    for n in SIZES:
+        items = make_items(n)
+        # keys and values are shared by every build, so only the containers and entries are measured
+        results = [
+            ('tuple', measure(lambda: {k: (v, True) for k, v in items})),
+            ('StorageEntry', measure(lambda: {k: StorageEntry(v, True) for k, v in items})),
+        ]
+
+        storage = LocalStorage(compact_ratio=None)
+        for k, v in items:
+            storage.add(k, v)
+        storage.store()
+        filename = storage.get_constructor_arguments()
+        del storage
+        results.append(('LocalStorage', measure(lambda: LocalStorage(filename, verify_on_load=False))))
+
+        storage = LocalStorage(compact_ratio=None, binary=True)
+        for k, v in items:
+            storage.add(k, v)
+        storage.store()
+        filename = storage.get_constructor_arguments()
+        del storage
+        results.append(('LocalStorage (binary)',
+                        measure(lambda: LocalStorage(filename, binary=True, verify_on_load=False))))
+
+        for name, size in results:
+            print('%-24s %10d %16.1f' % (name, n, size / n))
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,8 @@ class BaseConfig(object):
     SETTINGS_FILE = 'db/settings.db'
 
     USE_ETHEREUM = False
+    # number of IPC connections to geth used concurrently
+    ETHEREUM_POOL_SIZE = 4
 
 
 class DevelopmentTestConfig(BaseConfig):
@@ -6,6 +6,8 @@ contract Storage {
   string[2][] public data;
   uint public length;
 
+  event Added(uint indexed index, string key, string value);
+
   function Storage() public {
     owner = msg.sender;
   }
@@ -13,8 +15,72 @@ contract Storage {
   function add(string key, string value) public {
     if (msg.sender == owner) {
         data.push([key, value]);
+        Added(length, key, value);
+        length++;
+    }
+  }
+
+  // Appends the entries packed as returned by range
+  function add_batch(bytes packed) public {
+    if (msg.sender == owner) {
+      uint offset = 0;
+      while (offset < packed.length) {
+        string memory key = read_field(packed, offset);
+        offset += 4 + bytes(key).length;
+        string memory value = read_field(packed, offset);
+        offset += 4 + bytes(value).length;
+        data.push([key, value]);
+        Added(length, key, value);
         length++;
+      }
+    }
+  }
+
+  function read_field(bytes packed, uint offset) private pure returns (string) {
+    uint n = uint(uint8(packed[offset])) * 0x1000000 + uint(uint8(packed[offset + 1])) * 0x10000 +
+             uint(uint8(packed[offset + 2])) * 0x100 + uint(uint8(packed[offset + 3]));
+    bytes memory field = new bytes(n);
+    for (uint i = 0; i < n; i++) {
+      field[i] = packed[offset + 4 + i];
     }
+    return string(field);
+  }
+
+  // Returns the entries in [start, end) packed as (key length, key, value length, value), lengths as 4-byte
+  // big-endian integers. Stops before the result grows over max_size bytes, but returns at least one entry.
+  function range(uint start, uint end, uint max_size) public view returns (bytes) {
+    if (end > length) {
+      end = length;
+    }
+    uint size = 0;
+    uint stop = start;
+    while (stop < end) {
+      uint entry_size = 8 + bytes(data[stop][0]).length + bytes(data[stop][1]).length;
+      if (stop > start && size + entry_size > max_size) {
+        break;
+      }
+      size += entry_size;
+      stop++;
+    }
+
+    bytes memory result = new bytes(size);
+    uint offset = 0;
+    for (uint i = start; i < stop; i++) {
+      for (uint j = 0; j < 2; j++) {
+        bytes memory field = bytes(data[i][j]);
+        uint n = field.length;
+        result[offset] = byte(uint8(n / 0x1000000));
+        result[offset + 1] = byte(uint8(n / 0x10000));
+        result[offset + 2] = byte(uint8(n / 0x100));
+        result[offset + 3] = byte(uint8(n));
+        offset += 4;
+        for (uint b = 0; b < n; b++) {
+          result[offset + b] = field[b];
+        }
+        offset += n;
+      }
+    }
+    return result;
   }
 }
 
@@ -30,4 +96,9 @@ contract StorageFactory {
         Storage s = Storage(storage_address[msg.sender]);
         s.add(key, value);
     }
+
+    function add_batch(bytes packed) public {
+        Storage s = Storage(storage_address[msg.sender]);
+        s.add_batch(packed);
+    }
 }
@@ -16,6 +16,7 @@ from pathlib import Path
 
 import time
 
+from eth_utils import keccak
 from web3 import Web3, IPCProvider
 
 
@@ -40,11 +41,35 @@ def create_storage_factory(web3, account, abi, bytecode):
             return receipt['contractAddress']
 
 
-def compile_sol(filename, contract):
+# functions and events of storage.sol the server probes the deployed code for, falling back to slower calls without
+# them
+REQUIRED_FUNCTIONS = [
+    'range(uint256,uint256,uint256)',
+    'add_batch(bytes)',
+]
+REQUIRED_EVENTS = [
+    'Added(uint256,string,string)',
+]
+
+
+def compile_sol(filename):
+    """
+    Returns the `(abi, bin)` of each contract in `filename` by name.
+    """
     from solc import compile_files
-    compiled_contract = compile_files([filename])
-    compiled_contract = compiled_contract['%s:%s' % (filename, contract)]
-    return compiled_contract['abi'], compiled_contract['bin']
+    compiled = compile_files([filename])
+    return {name.split(':')[-1]: (contract['abi'], contract['bin']) for name, contract in compiled.items()}
+
+
+def missing_signatures(bytecode):
+    """
+    Returns the `REQUIRED_FUNCTIONS` whose selector is not pushed by the function dispatchers in `bytecode`, and the
+    `REQUIRED_EVENTS` whose topic is not pushed by the code emitting them, which means it was compiled from an older
+    storage.sol. The code of the factory embeds the code of the storage.
+    """
+    bytecode = bytecode.lower()
+    return ([signature for signature in REQUIRED_FUNCTIONS if keccak(signature.encode())[:4].hex() not in bytecode] +
+            [signature for signature in REQUIRED_EVENTS if keccak(signature.encode()).hex() not in bytecode])
 
 
 if __name__ == '__main__':
@@ -67,6 +92,27 @@ if __name__ == '__main__':
               + bcolors.ENDC)
         exit()
 
+    # the contracts are checked before anything is created
+    if args.compile:
+        compiled = compile_sol('./contracts/storage.sol')
+        storage_factory_abi, storage_factory_bin = compiled['StorageFactory']
+        json.dump(storage_factory_abi, open('contracts/storage_factory.abi.json', 'w'))
+        json.dump(compiled['Storage'][0], open('contracts/storage.abi.json', 'w'))
+        # the bytecode is written as plain hex
+        with open('contracts/storage_factory.bin', 'w') as f:
+            f.write(storage_factory_bin)
+    else:
+        storage_factory_abi = json.load(open('contracts/storage_factory.abi.json'))
+        storage_factory_bin = open('contracts/storage_factory.bin').read().strip()
+        if storage_factory_bin.startswith('"'):
+            # written as a JSON string by older versions of --compile
+            storage_factory_bin = json.loads(storage_factory_bin)
+    missing = missing_signatures(storage_factory_bin)
+    if missing:
+        print(bcolors.FAIL + 'contracts/storage_factory.bin was not compiled from contracts/storage.sol, it lacks '
+              + ', '.join(missing) + '. Run again with --compile (solc 0.4.19) to rebuild it.' + bcolors.ENDC)
+        exit()
+
     print(bcolors.OKGREEN + 'Creating the initial account, please remember the password' + bcolors.ENDC)
     os.system('geth account new --datadir . --keystore .')
     key_file_name = list(cwd.glob('UTC--*'))[0].name
@@ -114,13 +160,6 @@ if __name__ == '__main__':
 
         print('Deploying storage factory contract...')
         print('Also start mining, it will take a lot of time to generate DAG (~3 min)...')
-        if args.compile:
-            storage_factory_abi, storage_factory_bin = compile_sol('./contracts/storage.sol', 'StorageFactory')
-            json.dump(storage_factory_abi, open('contracts/storage_factory.abi.json', 'w'))
-            json.dump(storage_factory_bin, open('contracts/storage_factory.bin', 'w'))
-        else:
-            storage_factory_abi = json.load(open('contracts/storage_factory.abi.json'))
-            storage_factory_bin = open('contracts/storage_factory.bin').read().strip()
         factory_address = create_storage_factory(web3, init_address, storage_factory_abi, storage_factory_bin)
         print(bcolors.OKGREEN + 'The storage factory address is ' + factory_address + bcolors.ENDC)
     finally:
@@ -6,6 +6,7 @@ Use "python manage.py" for a list of available commands.
 Use "python manage.py runserver" to start the development web server on localhost:5000.
 Use "python manage.py runserver --help" for additional runserver options.
 """
+import os
 import unittest
 
 try:
@@ -17,6 +18,8 @@ from flask_migrate import MigrateCommand, Migrate
 from flask_script import Manager, Shell, Server
 
 from app import create_app, db
+from app.utils.exceptions import ChainIntegrityError
+from app.utils.local_storage import LocalStorage
 
 # Setup Flask-Script with command line commands
 app, socketio = create_app()
@@ -34,6 +37,24 @@ def test():
     return 1
 
 
+@manager.command
+def verify_chain(filename='chain', binary=False):
+    """Verifies the hash links of the local storage chain."""
+    # opening a missing chain would create a new one
+    extensions = ('bin',) if binary else ('chain', 'json')
+    if not any(os.path.exists('./db/%s.%s' % (filename, ext)) for ext in extensions):
+        print('No chain named %s in ./db' % filename)
+        return 1
+    try:
+        storage = LocalStorage(filename, binary=binary, verify_on_load=False)
+        checked = storage.verify()
+    except ChainIntegrityError as e:
+        print('Chain is broken:', e)
+        return 1
+    print('Chain is intact, %d new blocks checked' % checked)
+    return 0
+
+
 manager.add_command('db', MigrateCommand)
 manager.add_command("shell", Shell(make_context=lambda: dict(app=app, db=db)))
 manager.add_command('runserver', Server(threaded=True))
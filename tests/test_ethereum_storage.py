@@ -1,5 +1,8 @@
 import json
+import os
+import shutil
 import subprocess
+import tempfile
 import time
 import unittest
 
@@ -7,7 +10,8 @@ from web3 import Web3, IPCProvider
 
 from app.utils.ethereum_storage import EthereumStorage
 from app.utils.ethereum_utils import EthereumUtils
-from app.utils.misc import get_executable, get_env, get_ipc
+from app.utils.exceptions import StateError
+from app.utils.misc import get_executable, get_env, get_ipc, Priority
 
 
 class TestEthereumStorage(unittest.TestCase):
@@ -40,7 +44,14 @@ class TestEthereumStorage(unittest.TestCase):
         cls.geth.terminate()
 
     def setUp(self):
-        self.storage = EthereumStorage(self.account, self.password)
+        # each test has its own journal, the pending changes of the others would be sent again
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = os.path.join(self.directory.name, 'test.journal')
+        self.storage = EthereumStorage(self.account, self.password, self.journal)
+
+    def tearDown(self):
+        self.storage.terminate()
+        self.directory.cleanup()
 
     def test_add_get(self):
         size = len(self.storage)
@@ -90,14 +101,86 @@ class TestEthereumStorage(unittest.TestCase):
 
         self.assertLess(time2 / time1, 2)  # should take similar time
 
+    def test_ready(self):
+        self.assertTrue(self.storage.wait_ready(30))
+        self.assertTrue(self.storage.ready)
+        self.assertTrue(self.storage.wait_loaded(30))
+        self.assertTrue(self.storage.loaded)
+
+    def test_coalescing(self):
+        key = 'coalesce_%f' % time.time()
+        self.storage.add(key, '1')
+        self.storage.add(key, '2')
+        self.storage.delete(key)
+        metrics = self.storage.flush_metrics['interactive']
+        self.assertEqual(metrics['coalesced'], 1)
+        self.assertEqual(metrics['cancelled'], 1)
+        self.assertEqual(metrics['pending_keys'], 0)
+
+    def test_priority(self):
+        key = 'priority_%f' % time.time()
+        self.storage.add(key + '_bulk', '1', Priority.BULK)
+        self.storage.add(key + '_moved', '1', Priority.BULK)
+        self.storage.add(key + '_moved', '2')
+        metrics = self.storage.flush_metrics
+        self.assertEqual(metrics['bulk']['pending_keys'], 1)
+        self.assertEqual(metrics['interactive']['pending_keys'], 1)
+
+        self.storage.store(Priority.INTERACTIVE)
+        self.assertEqual(self.storage.flush_metrics['bulk']['pending_keys'], 1)
+        self.assertFalse(self.storage.get(key + '_bulk', True)[1])
+
+    def test_edit_during_sync(self):
+        key = 'sync_%f' % time.time()
+        self.storage.add(key, 'local')
+        # an older value of the key arrives while the edit is pending
+        self.assertFalse(self.storage.load_key_value(key, 'remote'))
+        self.assertEqual(self.storage.get(key, True), ('local', False))
+        # the key exists on the chain now, deleting it is a change to send
+        self.storage.delete(key)
+        self.assertIsNone(self.storage.get(key))
+        self.assertEqual(self.storage.flush_metrics['interactive']['pending_keys'], 1)
+        # changed back to the remote value, nothing to send
+        self.storage.add(key, 'remote')
+        self.assertEqual(self.storage.get(key, True), ('remote', True))
+        self.assertEqual(self.storage.flush_metrics['interactive']['pending_keys'], 0)
+
+    def test_bulk_edit_during_sync(self):
+        added = 'bulk_sync_add_%f' % time.time()
+        deleted = 'bulk_sync_del_%f' % time.time()
+        self.storage.load_key_value(deleted, 'remote')
+        self.storage.add(added, 'local', Priority.BULK)
+        self.storage.delete(deleted, Priority.BULK)
+        # bulk changes are not waited for before a sync, older values must not overwrite them either
+        self.assertFalse(self.storage.load_key_value(added, 'remote'))
+        self.assertFalse(self.storage.load_key_value(deleted, 'remote'))
+        self.assertEqual(self.storage.get(added, True), ('local', False))
+        self.assertIsNone(self.storage.get(deleted))
+        self.assertEqual(self.storage.flush_metrics['bulk']['pending_keys'], 2)
+
+    def test_journal(self):
+        key = 'journal_%f' % time.time()
+        self.storage.add(key, '1', Priority.BULK)
+        # a crash before the change is sent, the journal is only used by one storage at a time
+        with self.assertRaises(StateError):
+            EthereumStorage(self.account, self.password, self.journal)
+        crashed = os.path.join(self.directory.name, 'crashed.journal')
+        shutil.copy(self.journal, crashed)
+        # the change is restored from the journal before it is sent
+        restarted = EthereumStorage(self.account, self.password, crashed)
+        self.assertEqual(restarted.get(key, True), ('1', False))
+        self.assertEqual(restarted.flush_metrics['bulk']['pending_keys'], 1)
+        restarted.terminate()
+
     def test_persistent_storage(self):
-        storage = EthereumStorage(self.account, self.password)
+        storage = self.storage
         storage.add('a', '1')
         self.assertFalse(storage.get('a', True)[1])
         storage.store()
         self.assertTrue(storage.get('a', True)[1])
 
-        storage = EthereumStorage(self.account, self.password)
+        storage.terminate()
+        storage = self.storage = EthereumStorage(self.account, self.password, self.journal)
         self.assertEqual(storage.get('a'), '1')
         self.assertTrue(storage.get('a', True)[1])
         dic = storage.get_all()  # should be {'a': ('1', True)}
@@ -110,5 +193,6 @@ class TestEthereumStorage(unittest.TestCase):
         self.assertIsNone(storage.get('a', True)[1])
         storage.store()
 
-        storage = EthereumStorage(self.account, self.password)
+        storage.terminate()
+        storage = self.storage = EthereumStorage(self.account, self.password, self.journal)
         self.assertIsNone(storage.get('a'))
@@ -6,7 +6,7 @@ import unittest
 from web3 import Web3, IPCProvider
 
 from app import get_ipc
-from app.utils.ethereum_utils import EthereumUtils
+from app.utils.ethereum_utils import EthereumUtils, NonceManager, TransactionTracker, pack_entries, unpack_entries
 from app.utils.exceptions import StateError
 
 
@@ -29,7 +29,8 @@ class TestEthereumUtils(unittest.TestCase):
                                     stdout=subprocess.DEVNULL,
                                     stderr=subprocess.DEVNULL)
         time.sleep(5)
-        ethereum_utils = EthereumUtils(Web3(IPCProvider(get_ipc('./ethereum_private/data', 'geth.ipc'))))
+        ipc_path = get_ipc('./ethereum_private/data', 'geth.ipc')
+        ethereum_utils = EthereumUtils(Web3(IPCProvider(ipc_path)), ipc_path)
         storage_factory_abi = json.load(open('./ethereum_private/contracts/storage_factory.abi.json'))
         storage_abi = json.load(open('./ethereum_private/contracts/storage.abi.json'))
         ethereum_utils.init_contracts('0x40F2b5cEC3c436F66690ed48E01a48F6Da9Bad17', storage_factory_abi, storage_abi)
@@ -47,3 +48,188 @@ class TestEthereumUtils(unittest.TestCase):
         time.sleep(2.5)
         with self.assertRaises(StateError):
             self.ethereum_utils.add(self.account, 'x', 'y')
+
+    def test_get_history(self):
+        length = self.ethereum_utils.get_length(self.account)
+        progress = []
+        history = list(self.ethereum_utils.get_history(self.account, progress=lambda *args: progress.append(args)))
+        self.assertEqual(len(history), length)
+        for i in range(0, length, max(length // 10, 1)):
+            self.assertEqual(history[i], (self.ethereum_utils.get_element(self.account, i, 0),
+                                          self.ethereum_utils.get_element(self.account, i, 1)))
+        if length:
+            self.assertEqual(progress[-1], (length, length))
+
+    def test_get_range(self):
+        length = self.ethereum_utils.get_length(self.account)
+        elements = self.ethereum_utils.get_range(self.account, 0, length)
+        self.assertLessEqual(len(elements), length)
+        for i, element in enumerate(elements):
+            self.assertEqual(element, (self.ethereum_utils.get_element(self.account, i, 0),
+                                       self.ethereum_utils.get_element(self.account, i, 1)))
+
+    def test_get_added(self):
+        storage = self.ethereum_utils.get_storage(self.account)
+        if not self.ethereum_utils.has_added_event(storage):
+            self.skipTest('storage contract deployed without the Added event')
+        added = self.ethereum_utils.get_added(storage, 0, self.ethereum_utils.get_block_number())
+        self.assertEqual([i for i, _, _ in added], list(range(len(added))))
+        self.assertEqual([(k, v) for _, k, v in added], list(self.ethereum_utils.get_history(self.account)))
+
+    def test_pack_batches(self):
+        entries = [(str(i), 'x' * 300) for i in range(200)]
+        self.assertEqual(unpack_entries(pack_entries(entries)), entries)
+        batches = EthereumUtils.pack_batches(entries)
+        self.assertLess(len(batches), len(entries) // 4)
+        self.assertEqual([entry for batch in batches for entry in batch], entries)
+        self.assertGreater(len(EthereumUtils.pack_batches(entries, EthereumUtils.BATCH_GAS_LIMIT // 2)), len(batches))
+
+
+class TestTransactionTracker(unittest.TestCase):
+    class Node:
+        """
+        Answers the calls of the tracker, with the transactions in `mined` mined.
+        """
+
+        def __init__(self):
+            self.mined = set()
+
+        def new_block_filter(self):
+            return 1
+
+        def get_filter_changes(self, filter_id):
+            return [filter_id]
+
+        def uninstall_filter(self, filter_id):
+            pass
+
+        def get_transaction_receipts(self, transaction_hashes):
+            return [{'transactionHash': transaction_hash} if transaction_hash in self.mined else None
+                    for transaction_hash in transaction_hashes]
+
+    def test_wait(self):
+        node = TestTransactionTracker.Node()
+        tracker = TransactionTracker(node, poll_interval=0.01)
+        mined = []
+        node.mined.add('0x1')
+        self.assertEqual(tracker.wait(['0x1', '0x2'], lambda h, r: mined.append(h), 0.2), {'0x2'})
+        self.assertEqual(mined, ['0x1'])
+
+        # the transaction timed out is not tracked anymore
+        node.mined.add('0x2')
+        time.sleep(0.1)
+        self.assertEqual(mined, ['0x1'])
+
+    def test_untrack(self):
+        node = TestTransactionTracker.Node()
+        tracker = TransactionTracker(node, poll_interval=0.01)
+        mined = []
+        tracker.track('0x1', lambda h, r: mined.append(h))
+        tracker.untrack('0x1')
+        node.mined.add('0x1')
+        time.sleep(0.1)
+        self.assertEqual(mined, [])
+
+
+class TestNonceManager(unittest.TestCase):
+    class Node:
+        """
+        Answers the calls of the manager, `pending` transactions have been sent by the account, `mined` of them have
+        been mined, and the node does not know the transactions in `dropped`.
+        """
+
+        def __init__(self, pending: int = 0):
+            self.pending = pending
+            self.mined = 0
+            self.dropped = set()
+            self.empty = []
+
+        def get_transaction_count(self, account, block='latest'):
+            return self.mined if block == 'latest' else self.pending
+
+        def send_empty_transaction(self, account, nonce):
+            self.empty.append(nonce)
+            return '0xe%d' % nonce
+
+        def get_transaction(self, transaction_hash):
+            return None if transaction_hash in self.dropped else {}
+
+    def send(self, nonce):
+        return '0x%d' % nonce
+
+    def test_reserve_release(self):
+        manager = NonceManager(TestNonceManager.Node())
+        self.assertEqual(manager.transact('a', self.send), '0x0')
+
+        def failed(nonce):
+            raise OSError('node unreachable')
+        # the nonce is handed back, the next transaction uses it
+        self.assertRaises(OSError, manager.transact, 'a', failed)
+        self.assertEqual(manager.transact('a', self.send), '0x1')
+
+        def failed_after_later(nonce):
+            manager.transact('a', self.send)
+            raise OSError('node unreachable')
+        # a later nonce is in use, the failed one is left as a gap
+        self.assertRaises(OSError, manager.transact, 'a', failed_after_later)
+        self.assertEqual(manager.transact('a', self.send), '0x4')
+
+    def test_resync(self):
+        node = TestNonceManager.Node(pending=5)
+        manager = NonceManager(node)
+        self.assertEqual(manager.transact('a', self.send), '0x5')
+
+        # the nonces have been used outside of the manager
+        node.pending = 8
+        nonces = []
+
+        def send(nonce):
+            nonces.append(nonce)
+            if nonce < 8:
+                raise ValueError('nonce too low')
+            return self.send(nonce)
+        self.assertEqual(manager.transact('a', send), '0x8')
+        self.assertEqual(nonces, [6, 8])
+
+    def test_refill_gaps(self):
+        # the transaction with nonce 0 was sent before a restart
+        node = TestNonceManager.Node(pending=1)
+        manager = NonceManager(node)
+        manager.transact('a', self.send)
+
+        def failed_after_later(nonce):
+            manager.transact('a', self.send)
+            raise OSError('node unreachable')
+        self.assertRaises(OSError, manager.transact, 'a', failed_after_later)
+
+        # only the nonce released by the failed send is filled, the lost transaction is sent again
+        node.dropped.add('0x3')
+        self.assertEqual(manager.refill_gaps('a'), {'0x3': '0x3'})
+        self.assertEqual(node.empty, [2])
+        self.assertEqual(manager.refill_gaps('a'), {'0x3': '0x3'})
+        self.assertEqual(node.empty, [2])
+
+        # nothing is sent for the mined nonces
+        node.mined = 4
+        self.assertEqual(manager.refill_gaps('a'), {})
+        self.assertEqual(node.empty, [2])
+
+    def test_refill_used_gap(self):
+        node = TestNonceManager.Node()
+        manager = NonceManager(node)
+
+        def failed_after_later(nonce):
+            manager.transact('a', self.send)
+            raise OSError('node unreachable')
+        self.assertRaises(OSError, manager.transact, 'a', failed_after_later)
+
+        attempts = []
+
+        def used(account, nonce):
+            attempts.append(nonce)
+            raise ValueError('nonce too low')
+        # the nonce has been used meanwhile, it is not filled again
+        node.send_empty_transaction = used
+        self.assertEqual(manager.refill_gaps('a'), {})
+        self.assertEqual(manager.refill_gaps('a'), {})
+        self.assertEqual(attempts, [0])
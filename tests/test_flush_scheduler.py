@@ -0,0 +1,92 @@
+import time
+import unittest
+from threading import Thread
+
+from app.utils.flush_scheduler import FlushScheduler
+
+
+class TestFlushScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.scheduler = FlushScheduler(idle_delay=2, max_delay=15, max_count=3, max_bytes=100,
+                                        clock=lambda: self.now)
+
+    def test_idle_and_max_delay(self):
+        self.assertIsNone(self.scheduler.due())
+        self.scheduler.changed('a', 10)
+        self.now = 1
+        self.assertIsNone(self.scheduler.due())
+        self.now = 3
+        self.assertEqual(self.scheduler.due(), 'idle')
+        self.scheduler.take()
+        self.assertIsNone(self.scheduler.due())
+
+        # changed every second, never idle
+        for i in range(16):
+            self.now = 10 + i
+            self.scheduler.changed('b', 10)
+        self.assertEqual(self.scheduler.due(), 'max_delay')
+
+    def test_thresholds(self):
+        self.scheduler.changed('a', 10)
+        self.scheduler.changed('b', 10)
+        self.assertIsNone(self.scheduler.due())
+        self.scheduler.changed('c', 10)
+        self.assertEqual(self.scheduler.due(), 'count')
+        self.scheduler.take()
+
+        # the keys left pending are still due
+        for key in 'abcd':
+            self.scheduler.changed(key, 10)
+        self.scheduler.take(['a', 'b'])
+        self.assertEqual(self.scheduler.metrics['pending_keys'], 2)
+        self.now = 15
+        self.assertEqual(self.scheduler.due(), 'max_delay')
+        self.scheduler.take(['c', 'd'])
+        self.assertEqual(self.scheduler.metrics['flushed_keys'], 7)
+
+        self.scheduler.changed('a', 99)
+        self.assertIsNone(self.scheduler.due())
+        self.scheduler.changed('a', 100)
+        self.assertEqual(self.scheduler.due(), 'bytes')
+
+    def test_coalesce_and_cancel(self):
+        self.scheduler.changed('a', 10)
+        self.scheduler.changed('a', 20)
+        self.scheduler.changed('b', 10)
+        self.scheduler.cancel('b')
+        self.scheduler.cancel('c')
+        self.scheduler.skip()
+        metrics = self.scheduler.metrics
+        self.assertEqual(metrics['coalesced'], 1)
+        self.assertEqual(metrics['cancelled'], 1)
+        self.assertEqual(metrics['skipped'], 1)
+        self.assertEqual(metrics['pending_keys'], 1)
+        self.assertEqual(metrics['pending_bytes'], 20)
+
+        self.scheduler.discard('a')
+        self.assertIsNone(self.scheduler.due())
+        self.now = 100
+        self.assertIsNone(self.scheduler.due())
+
+    def test_wait(self):
+        scheduler = FlushScheduler(idle_delay=0.05)
+        scheduler.changed('a', 10)
+        self.assertEqual(scheduler.wait(), 'idle')
+        scheduler.take()
+
+        waiter = Thread(target=scheduler.wait_empty)
+        scheduler.changed('b', 10)
+        waiter.start()
+        time.sleep(0.05)
+        self.assertTrue(waiter.is_alive())
+        scheduler.take()
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+
+        scheduler.stop()
+        self.assertEqual(scheduler.wait(), 'terminate')
+        metrics = scheduler.metrics
+        self.assertEqual(metrics['flushes']['idle'], 1)
+        self.assertEqual(metrics['flushes']['terminate'], 1)
+        self.assertEqual(metrics['flushed_keys'], 2)
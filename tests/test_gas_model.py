@@ -0,0 +1,31 @@
+import unittest
+
+from app.utils.gas_model import GasModel, storage_slots
+
+
+class TestGasModel(unittest.TestCase):
+    @staticmethod
+    def node_estimate(key_length: int, value_length: int) -> int:
+        slots = storage_slots(key_length) + storage_slots(value_length)
+        return 32000 + 20000 * slots + 68 * (key_length + value_length)
+
+    def test_storage_slots(self):
+        self.assertEqual(storage_slots(0), 0)
+        self.assertEqual(storage_slots(31), 1)
+        self.assertEqual(storage_slots(32), 2)
+        self.assertEqual(storage_slots(65), 4)
+
+    def test_estimate(self):
+        calls = []
+        model = GasModel(lambda k, v: calls.append((k, v)) or self.node_estimate(k, v))
+        self.assertEqual(len(calls), len(GasModel.CALIBRATION_LENGTHS))
+        self.assertLess(model.error, 1e-6)
+
+        for key_length, value_length in ((1, 0), (10, 88), (40, 300), (5, 2000)):
+            gas, error = model.estimate(key_length, value_length)
+            expected = self.node_estimate(key_length, value_length)
+            # rounded up to the end of the call data bucket
+            self.assertGreaterEqual(gas, expected - 1)
+            self.assertLess(gas, expected + 68 * GasModel.BUCKET_SIZE)
+            self.assertEqual(error, model.error)
+        self.assertEqual(len(calls), len(GasModel.CALIBRATION_LENGTHS))
@@ -0,0 +1,59 @@
+import time
+import unittest
+from threading import Thread
+
+from app.utils.ipc import ConnectionPool
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_checkout(self):
+        created = []
+        pool = ConnectionPool(lambda: created.append(object()) or created[-1], 2)
+        with pool.connection() as first:
+            # nested checkouts reuse the connection of the thread
+            with pool.connection() as nested:
+                self.assertIs(nested, first)
+                self.assertIs(pool.current(), first)
+            with pool.connection() as again:
+                self.assertIs(again, first)
+        with self.assertRaises(RuntimeError):
+            pool.current()
+        self.assertEqual(len(created), 1)
+
+    def test_size(self):
+        created = []
+        pool = ConnectionPool(lambda: created.append(object()) or created[-1], 2)
+        in_use = []
+        most = []
+
+        def worker():
+            with pool.connection() as connection:
+                in_use.append(connection)
+                most.append(len(in_use))
+                time.sleep(0.05)
+                in_use.remove(connection)
+
+        threads = [Thread(target=worker) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(created), 2)
+        self.assertLessEqual(max(most), 2)
+
+    def test_broken_connection(self):
+        created = []
+        pool = ConnectionPool(lambda: created.append(object()) or created[-1], 1)
+        with self.assertRaises(OSError):
+            with pool.connection():
+                raise TimeoutError()
+        # thrown away and replaced
+        with pool.connection() as connection:
+            self.assertIs(connection, created[-1])
+        self.assertEqual(len(created), 2)
+        with self.assertRaises(ValueError):
+            with pool.connection():
+                raise ValueError()
+        with pool.connection():
+            pass
+        self.assertEqual(len(created), 2)
@@ -1,8 +1,13 @@
+import json
+import os
 import unittest
+from unittest import mock
 
 import time
 
-from app.utils.local_storage import LocalStorage
+from app.utils.exceptions import ChainIntegrityError
+from app.utils.local_storage import LocalStorage, _ChainVerifier
+from app.utils.misc import hash_dict, hash_block
 
 
 class TestLocalStorage(unittest.TestCase):
@@ -78,3 +83,336 @@ class TestLocalStorage(unittest.TestCase):
 
         storage = LocalStorage(filename)
         self.assertIsNone(storage.get('a'))
+
+    def test_append_only_log(self):
+        storage = LocalStorage()
+        filename = storage.get_constructor_arguments()
+        storage.add('a', '1')
+        storage.store()
+        with open('./db/%s.chain' % filename) as f:
+            first = f.read()
+
+        storage.add('b', '2')
+        storage.store()
+        with open('./db/%s.chain' % filename) as f:
+            second = f.read()
+        self.assertTrue(second.startswith(first))
+        self.assertEqual(len(second.splitlines()), 3)
+
+        # a torn append is dropped on the next load
+        with open('./db/%s.chain' % filename, 'a') as f:
+            f.write('{"pre_block": "')
+        storage = LocalStorage(filename)
+        self.assertEqual(storage.get('b'), '2')
+        storage.add('c', '3')
+        storage.store()
+        storage = LocalStorage(filename)
+        self.assertEqual(storage.get('c'), '3')
+
+    def test_failed_append(self):
+        for binary in (False, True):
+            storage = LocalStorage(binary=binary)
+            filename = storage.get_constructor_arguments()
+            storage.add('a', '1')
+            storage.store()
+            storage.add('b', '2')
+            storage.delete('a')
+            with mock.patch('os.fsync', side_effect=OSError('disk full')):
+                self.assertRaises(OSError, storage.store)
+            # nothing is written, the changes are still pending
+            self.assertEqual(storage.get('b', True), ('2', False))
+            self.assertEqual(storage.get('a', True), (None, None))
+            storage.store()
+            self.assertEqual(storage.verify(), 3)
+
+            storage = LocalStorage(filename, binary=binary)
+            self.assertEqual(storage.get('b'), '2')
+            self.assertIsNone(storage.get('a'))
+
+    def test_legacy_json_file(self):
+        filename = 'tmp/legacy_' + str(int(time.time() * 1000))
+        os.makedirs('./db/tmp', exist_ok=True)
+        with open('./db/%s.json' % filename, 'w') as f:
+            json.dump([LocalStorage.Database.GENESIS, {
+                "pre_block": hash_dict(LocalStorage.Database.GENESIS),
+                "arguments": {
+                    "key": "a",
+                    "value": "1"
+                }
+            }], f)
+        storage = LocalStorage(filename)
+        self.assertEqual(storage.get('a'), '1')
+        self.assertTrue(os.path.exists('./db/%s.chain' % filename))
+        storage.add('b', '2')
+        storage.store()
+        self.assertEqual(storage.verify(), 1)
+        os.remove('./db/%s.verified' % filename)
+        self.assertEqual(storage.verify(), 3)
+
+    def test_large_legacy_json_file(self):
+        filename = 'tmp/legacy_' + str(int(time.time() * 1000))
+        os.makedirs('./db/tmp', exist_ok=True)
+        blocks = [LocalStorage.Database.GENESIS]
+        for i in range(3000):
+            blocks.append({
+                "pre_block": hash_dict(blocks[-1]),
+                "arguments": {
+                    "key": str(i % 100),
+                    "value": str(i)
+                }
+            })
+        with open('./db/%s.json' % filename, 'w') as f:
+            json.dump(blocks, f, indent=2)
+        # the array is streamed and spans many read chunks
+        self.assertGreater(os.path.getsize('./db/%s.json' % filename), 4 * 64 * 1024)
+
+        storage = LocalStorage(filename)
+        self.assertEqual(storage.size(), 100)
+        self.assertEqual(storage.get('7'), '2907')
+        os.remove('./db/%s.verified' % filename)
+        self.assertEqual(storage.verify(), 3001)
+
+    def test_block_hashes(self):
+        storage = LocalStorage()
+        filename = storage.get_constructor_arguments()
+        for i in range(5):
+            storage.add(str(i), str(i))
+        storage.store()
+        storage.delete('0')
+        storage.store()
+
+        with open('./db/%s.chain' % filename) as f:
+            blocks = [json.loads(line) for line in f]
+        self.assertEqual(len(blocks), 7)
+        for i, block in enumerate(blocks):
+            arguments = block['arguments']
+            self.assertEqual(block['hash'], hash_block(block['pre_block'], arguments['key'], arguments['value']))
+            if i > 0:
+                self.assertEqual(block['pre_block'], blocks[i - 1]['hash'])
+
+        # the chain continues from the persisted tip after reloading
+        storage = LocalStorage(filename)
+        storage.add('a', '1')
+        storage.store()
+        with open('./db/%s.chain' % filename) as f:
+            last = json.loads(f.readlines()[-1])
+        self.assertEqual(last['pre_block'], blocks[-1]['hash'])
+
+    def test_compact(self):
+        storage = LocalStorage(compact_ratio=None)
+        filename = storage.get_constructor_arguments()
+        for i in range(10):
+            storage.add('a', str(i))
+            storage.add('b', str(i))
+            storage.store()
+        storage.delete('b')
+        storage.add('c', '1')
+        storage.compact()
+        self.assertEqual(os.path.getsize('./db/%s.chain' % filename), 0)
+
+        storage.add('d', '1')
+        storage.store()
+        storage = LocalStorage(filename)
+        self.assertEqual(storage.get('a'), '9')
+        self.assertIsNone(storage.get('b'))
+        self.assertEqual(storage.get('c', True), ('1', True))
+        self.assertEqual(storage.get('d'), '1')
+        self.assertEqual(len(storage), 3)
+
+    def test_auto_compact(self):
+        storage = LocalStorage(compact_ratio=2.0, compact_min_dead=10)
+        filename = storage.get_constructor_arguments()
+        for i in range(5):
+            storage.add('a', str(i))
+            storage.store()
+        self.assertFalse(os.path.exists('./db/%s.snapshot' % filename))
+        for i in range(10):
+            storage.add('a', str(i))
+            storage.store()
+        self.assertTrue(os.path.exists('./db/%s.snapshot' % filename))
+        storage = LocalStorage(filename)
+        self.assertEqual(storage.get('a'), '9')
+
+    def test_binary_format(self):
+        storage = LocalStorage(compact_ratio=None, binary=True)
+        filename = storage.get_constructor_arguments()
+        for i in range(5):
+            storage.add(str(i), str(i) * 100)
+        storage.store()
+        storage.add('0', 'x')
+        storage.delete('1')
+        self.assertEqual(storage.get('2', True), ('2' * 100, True))
+        self.assertEqual(storage.get('0', True), ('x', False))
+        storage.store()
+
+        storage = LocalStorage(filename, binary=True)
+        self.assertEqual(len(storage), 4)
+        self.assertEqual(storage.get('0'), 'x')
+        self.assertIsNone(storage.get('1'))
+        self.assertEqual(storage.get_all()['4'], ('4' * 100, True))
+
+        storage.compact()
+        storage.add('5', '5')
+        storage.store()
+        storage = LocalStorage(filename, binary=True)
+        self.assertEqual(storage.get('0'), 'x')
+        self.assertEqual(storage.get('3'), '3' * 100)
+        self.assertEqual(storage.get('5'), '5')
+        self.assertEqual(len(storage), 5)
+
+    def test_binary_index(self):
+        LocalStorage.BinaryDatabase.INDEX_INTERVAL = 4
+        try:
+            storage = LocalStorage(binary=True)
+            filename = storage.get_constructor_arguments()
+            for i in range(10):
+                storage.add(str(i % 3), str(i))
+                storage.store()
+            self.assertTrue(os.path.exists('./db/%s.idx' % filename))
+            storage = LocalStorage(filename, binary=True)
+            self.assertEqual([storage.get(str(i)) for i in range(3)], ['9', '7', '8'])
+        finally:
+            LocalStorage.BinaryDatabase.INDEX_INTERVAL = 1024
+
+    def test_lazy_values(self):
+        storage = LocalStorage(binary=True, cache_size=250)
+        filename = storage.get_constructor_arguments()
+        for i in range(10):
+            storage.add(str(i), str(i) * 100)
+        storage.store()
+
+        storage = LocalStorage(filename, binary=True, cache_size=250)
+        for i in range(10):
+            self.assertEqual(storage.get(str(i)), str(i) * 100)
+        view = storage.get_all()
+        self.assertEqual(len(view), 10)
+        self.assertEqual(view['3'], ('3' * 100, True))
+        self.assertNotIn('10', view)
+        self.assertEqual(dict(view.items()), {str(i): (str(i) * 100, True) for i in range(10)})
+
+        # changing the storage while iterating
+        for k in view:
+            storage.add(k + 'x', k)
+        self.assertEqual(len(view), 20)
+
+    def test_background_flush(self):
+        storage = LocalStorage(flush_interval=60, flush_size=5)
+        filename = storage.get_constructor_arguments()
+        storage.add('a', '1')
+        storage.flush()
+        self.assertTrue(storage.get('a', True)[1])
+
+        # the size trigger commits without an explicit flush
+        for i in range(5):
+            storage.add(str(i), str(i))
+        for _ in range(100):
+            if storage.get('4', True)[1]:
+                break
+            time.sleep(0.01)
+        self.assertTrue(storage.get('4', True)[1])
+
+        # a failed flush is reported and retried
+        storage.add('b', '2')
+        with mock.patch('os.fsync', side_effect=OSError('disk full')):
+            self.assertRaises(OSError, storage.flush)
+        self.assertFalse(storage.get('b', True)[1])
+        storage.flush()
+        self.assertTrue(storage.get('b', True)[1])
+
+        storage.delete('a')
+        storage.terminate()
+        # committed by the caller once the flusher has stopped
+        storage.add('c', '3')
+        storage.flush()
+        storage = LocalStorage(filename)
+        self.assertIsNone(storage.get('a'))
+        self.assertEqual(storage.get('4'), '4')
+        self.assertEqual(storage.get('c'), '3')
+
+    def test_verify(self):
+        storage = LocalStorage()
+        filename = storage.get_constructor_arguments()
+        for i in range(10):
+            storage.add(str(i), str(i))
+            storage.store()
+        self.assertEqual(storage.verify(), 10)
+        # the checkpoint is not rewritten when nothing new is verified
+        os.utime('./db/%s.verified' % filename, (0, 0))
+        self.assertEqual(storage.verify(), 0)
+        self.assertEqual(os.path.getmtime('./db/%s.verified' % filename), 0)
+        storage.add('a', '1')
+        storage.store()
+        self.assertEqual(storage.verify(), 1)
+
+        with open('./db/%s.chain' % filename) as f:
+            lines = f.readlines()
+        block = json.loads(lines[3])
+        block['arguments']['value'] = 'x'
+        lines[3] = json.dumps(block) + '\n'
+        with open('./db/%s.chain' % filename, 'w') as f:
+            f.writelines(lines)
+        os.remove('./db/%s.verified' % filename)
+        with self.assertRaises(ChainIntegrityError):
+            LocalStorage(filename)
+        self.assertEqual(LocalStorage(filename, verify_on_load=False).get('2'), 'x')
+
+    def test_verify_parallel(self):
+        LocalStorage.PARALLEL_VERIFY_THRESHOLD = 10
+        LocalStorage.VERIFY_CHUNK_SIZE = 3
+        try:
+            storage = LocalStorage(binary=True)
+            filename = storage.get_constructor_arguments()
+            for i in range(20):
+                storage.add(str(i), str(i))
+            storage.store()
+            self.assertEqual(storage.verify(), 20)
+            storage.compact()
+            storage.add('a', '1')
+            storage.store()
+            self.assertEqual(LocalStorage(filename, binary=True).verify(), 0)
+        finally:
+            LocalStorage.PARALLEL_VERIFY_THRESHOLD = 4096
+            LocalStorage.VERIFY_CHUNK_SIZE = 1024
+
+    def test_verify_resume(self):
+        for binary in (False, True):
+            storage = LocalStorage(binary=binary)
+            filename = storage.get_constructor_arguments()
+            for i in range(50):
+                storage.add(str(i), str(i))
+            storage.store()
+            self.assertEqual(storage.verify(), 50)
+            storage.add('a', '1')
+            storage.store()
+            # only the last verified block is read again
+            with mock.patch.object(_ChainVerifier, 'feed', autospec=True, side_effect=_ChainVerifier.feed) as feed:
+                self.assertEqual(storage.verify(), 1)
+            self.assertEqual(feed.call_count, 2)
+
+            # a checkpoint pointing into the middle of a block is dropped
+            checkpoint_path = './db/%s.verified' % filename
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            checkpoint["offset"] += 1
+            with open(checkpoint_path, 'w') as f:
+                json.dump(checkpoint, f)
+            self.assertEqual(LocalStorage(filename, binary=binary, verify_on_load=False).verify(), 52)
+
+    def test_total_cost(self):
+        storage = LocalStorage()
+        self.assertEqual(storage.calculate_total_cost(), 0)
+        storage.add('a', '1')
+        storage.add('b', '22')
+        storage.add('b', '333')
+        self.assertEqual(storage.calculate_total_cost(),
+                         LocalStorage.operation_cost('a', '1') + LocalStorage.operation_cost('b', '333'))
+        storage.delete('a')
+        self.assertEqual(storage.calculate_total_cost(), LocalStorage.operation_cost('b', '333'))
+        storage.store()
+        self.assertEqual(storage.calculate_total_cost(), 0)
+
+        storage.add('b', '4')
+        storage.delete('b')
+        self.assertEqual(storage.calculate_total_cost(), LocalStorage.operation_cost('b'))
+        storage.add('b', '5')
+        self.assertEqual(storage.calculate_total_cost(), LocalStorage.operation_cost('b', '5'))
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+
+from app.utils.exceptions import StateError
+from app.utils.write_journal import WriteJournal
+
+
+class TestWriteJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.journal')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replay(self):
+        journal = WriteJournal(self.path, fsync=False)
+        journal.write('a', '1', 'interactive')
+        journal.write('b', '2', 'bulk')
+        journal.write('c', '', 'interactive')
+        journal.write('d', '4', 'interactive')
+        journal.drop('d')
+        journal.sent([('a', '1'), ('b', '2')], '0x1')
+        journal.write('a', '3', 'interactive')
+        journal.sent([('c', '')], '0x2')
+        journal.resent('0x2', '0x3')
+        journal.mined('0x3')
+        journal.close()
+
+        journal = WriteJournal(self.path, fsync=False)
+        self.assertEqual(journal.pending, {'a': ('3', 'interactive')})
+        self.assertEqual(journal.in_flight, {'0x1': [('a', '1'), ('b', '2')]})
+        journal.close()
+
+        # compacted when opened, and replayed the same
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        journal = WriteJournal(self.path, fsync=False)
+        self.assertEqual(journal.pending, {'a': ('3', 'interactive')})
+        self.assertEqual(journal.in_flight, {'0x1': [('a', '1'), ('b', '2')]})
+        journal.close()
+
+    def test_pending_and_in_flight_same_value(self):
+        journal = WriteJournal(self.path, fsync=False)
+        journal.write('a', '1', 'interactive')
+        journal.sent([('a', '1')], '0x1')
+        journal.write('a', '2', 'interactive')
+        journal.write('a', '1', 'interactive')
+        journal.close()
+
+        for _ in range(2):
+            journal = WriteJournal(self.path, fsync=False)
+            self.assertEqual(journal.pending, {'a': ('1', 'interactive')})
+            self.assertEqual(journal.in_flight, {'0x1': [('a', '1')]})
+            journal.close()
+
+    def test_torn_record(self):
+        journal = WriteJournal(self.path, fsync=False)
+        journal.write('a', '1', 'interactive')
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('["w", "b", "2", "inter')
+
+        journal = WriteJournal(self.path, fsync=False)
+        self.assertEqual(journal.pending, {'a': ('1', 'interactive')})
+        journal.write('c', '3', 'bulk')
+        journal.close()
+        journal = WriteJournal(self.path, fsync=False)
+        self.assertEqual(journal.pending, {'a': ('1', 'interactive'), 'c': ('3', 'bulk')})
+        journal.close()
+
+    def test_compaction(self):
+        journal = WriteJournal(self.path, fsync=False)
+        for i in range(WriteJournal.COMPACT_MIN_RECORDS * 2):
+            journal.write('a', str(i), 'interactive')
+        with open(self.path) as f:
+            self.assertLess(len(f.readlines()), WriteJournal.COMPACT_MIN_RECORDS)
+        journal.close()
+        journal = WriteJournal(self.path, fsync=False)
+        self.assertEqual(journal.pending, {'a': (str(WriteJournal.COMPACT_MIN_RECORDS * 2 - 1), 'interactive')})
+        journal.close()
+
+    def test_lock(self):
+        journal = WriteJournal(self.path, fsync=False)
+        with self.assertRaises(StateError):
+            WriteJournal(self.path, fsync=False)
+        # still usable after compacting replaced the file
+        for i in range(WriteJournal.COMPACT_MIN_RECORDS + 1):
+            journal.write('a', str(i), 'interactive')
+        with self.assertRaises(StateError):
+            WriteJournal(self.path, fsync=False)
+        journal.close()
+        journal = WriteJournal(self.path, fsync=False)
+        journal.close()